@@ -0,0 +1,199 @@
+import logging
+import os
+from collections import Counter
+import dotenv
+import ollama
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# How the chat history was fitted into the budget in this worker: turns
+# replayed verbatim, turns over the budget and left to the summary, and
+# summary model calls
+stats = Counter()
+
+client = ollama.AsyncClient()
+
+# Tokens of earlier conversation sent with each message, summary included
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Most recent history entries considered for replaying
+CONTEXT_MAX_ENTRIES = int(os.getenv("CONTEXT_MAX_ENTRIES", "20"))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "llama3.1")
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "250"))
+# Rough number of characters per token of English text, for estimating
+CHARS_PER_TOKEN = 4
+
+SUMMARY_PROMPT = """
+Update the summary of a conversation between a user and a nutrition assistant.
+Keep what matters for later answers: the user's goals, preferences, foods they ate, recipes discussed and advice given.
+Leave out exact nutrient tables and full recipe texts. Answer with the updated summary only, in at most {max_words} words.
+
+Current summary:
+{summary}
+
+New messages:
+{turns}
+"""
+
+
+def estimate_tokens(text):
+    # The chat model's tokenizer is not available here, so estimate from the
+    # length. This errs on the high side for typical English text.
+    return (len(text or "") + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def turn_messages(entry):
+    messages = []
+    if entry.get("user_message"):
+        messages.append({"role": "user", "content": entry["user_message"]})
+    if entry.get("bot_message"):
+        messages.append({"role": "assistant", "content": entry["bot_message"]})
+    return messages
+
+
+def summary_message(summary):
+    return {
+        "role": "user",
+        "content": f"Summary of our conversation so far: {summary}",
+    }
+
+
+def context_pipeline(chat_id):
+    # The summary and the most recent entries, without images
+    entry = {
+        "user_message": "$$entry.user_message",
+        "bot_message": "$$entry.bot_message",
+        "image_result": "$$entry.image_result",
+        "nutrition_message": "$$entry.nutrition_message",
+    }
+    return [
+        {"$match": {"chat_id": chat_id}},
+        {
+            "$project": {
+                "_id": 0,
+                "summary": 1,
+                "summary_upto": 1,
+                "total": {"$size": {"$ifNull": ["$history", []]}},
+                "history": {
+                    "$map": {
+                        "input": {
+                            "$slice": [
+                                {"$ifNull": ["$history", []]},
+                                -CONTEXT_MAX_ENTRIES,
+                            ]
+                        },
+                        "as": "entry",
+                        "in": entry,
+                    }
+                },
+            }
+        },
+    ]
+
+
+async def build_context(chat_collection, chat_id, budget=CONTEXT_TOKEN_BUDGET):
+    # Earlier conversation for the next prompt, fitted into the token budget.
+    # Turns are replayed newest first while they fit, older turns are covered
+    # by the rolling summary stored on the chat document. Returns the
+    # messages and the turns the summary should take in next, as
+    # (summary_upto, [(index, entry), ...]), or None when it is up to date.
+    cursor = await chat_collection.aggregate(context_pipeline(chat_id))
+    chat_documents = await cursor.to_list()
+    if not chat_documents:
+        return [], None
+    chat = chat_documents[0]
+
+    summary = chat.get("summary") or ""
+    summary_upto = chat.get("summary_upto") or 0
+    first_index = chat["total"] - len(chat["history"])
+    entries = [
+        (index, entry)
+        for index, entry in enumerate(chat["history"], start=first_index)
+        if index >= summary_upto
+    ]
+
+    available = budget - (estimate_tokens(summary) if summary else 0)
+    used = 0
+    kept = []
+    # Newest turns that fit in half the budget
+    settled = 0
+    for _, entry in reversed(entries):
+        messages = turn_messages(entry)
+        used += sum(estimate_tokens(message["content"]) for message in messages)
+        if used > available:
+            break
+        kept.append(messages)
+        if used <= available // 2:
+            settled += 1
+    kept.reverse()
+    stats["replayed"] += len(kept)
+    stats["over_budget"] += len(entries) - len(kept)
+
+    messages = [summary_message(summary)] if summary else []
+    for turn in kept:
+        messages.extend(turn)
+    if len(kept) == len(entries):
+        return messages, None
+    # Turns that did not fit go to the summary, along with their image and
+    # nutrition data, which are never replayed. So that the summary is not
+    # updated for every message, it also takes in the older turns that fit,
+    # leaving half the budget to fill up again.
+    return messages, (summary_upto, entries[: len(entries) - settled])
+
+
+def format_turns(entries):
+    lines = []
+    for _, entry in entries:
+        lines.append(f"User: {entry.get('user_message') or ''}")
+        if entry.get("image_result"):
+            lines.append(f"Image recognition results: {entry['image_result']}")
+        if entry.get("nutrition_message"):
+            lines.append(f"Nutritional data: {entry['nutrition_message']}")
+        lines.append(f"Assistant: {entry.get('bot_message') or ''}")
+    return "\n".join(lines)
+
+
+async def update_summary(chat_collection, chat_id, pending):
+    # Fold the pending turns into the stored summary. Runs after the reply
+    # has been sent, so it never delays one.
+    summary_upto, entries = pending
+    chat = await chat_collection.find_one(
+        {"chat_id": chat_id}, {"_id": 0, "summary": 1, "summary_upto": 1}
+    )
+    if chat is None or (chat.get("summary_upto") or 0) != summary_upto:
+        # Another request already moved the summary on
+        return
+
+    prompt = SUMMARY_PROMPT.format(
+        max_words=SUMMARY_MAX_TOKENS * 3 // 4,
+        summary=chat.get("summary") or "(none yet)",
+        turns=format_turns(entries),
+    )
+    try:
+        response = await client.chat(
+            model=SUMMARY_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            options={"temperature": 0, "num_predict": SUMMARY_MAX_TOKENS},
+        )
+    except Exception as e:
+        stats["summary_errors"] += 1
+        logger.error("Summarizing chat %s failed: %s", chat_id, e)
+        return
+    stats["summaries"] += 1
+
+    # Only store it if no other summary was stored in the meantime. A
+    # missing summary_upto matches None.
+    await chat_collection.update_one(
+        {"chat_id": chat_id, "summary_upto": summary_upto or None},
+        {
+            "$set": {
+                "summary": response["message"]["content"].strip(),
+                "summary_upto": entries[-1][0] + 1,
+            }
+        },
+    )
+
+
+def context_stats():
+    return dict(stats)
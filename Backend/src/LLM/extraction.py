@@ -0,0 +1,123 @@
+import json
+import logging
+from collections import Counter
+import ollama
+import food_matcher
+
+logger = logging.getLogger(__name__)
+
+# How messages were extracted in this worker: "fast_path" for dictionary
+# matches, "cache" for cached model extractions, "model" for model calls
+stats = Counter()
+
+client = ollama.AsyncClient()
+
+EXTRACTION_MODEL = "llama3.1"
+# Bump when the prompt or schema changes, so cached extractions are not reused
+PROMPT_VERSION = 1
+INTENTS = ("recipe", "nutrition", "general")
+
+# JSON schema passed to Ollama as the response format, so the model returns
+# every field in one call
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "intent": {"type": "string", "enum": list(INTENTS)},
+        "foods": {"type": "array", "items": {"type": "string"}},
+        "recipes": {"type": "array", "items": {"type": "string"}},
+        "components": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["intent", "foods", "recipes", "components"],
+}
+
+EXTRACTION_PROMPT = """
+Carefully read the following text and extract what it explicitly mentions.
+Return a JSON object with these fields:
+- "intent": "recipe" if the user asks for a recipe, "nutrition" if they ask about foods they ate or their nutrients, otherwise "general".
+- "foods": the exact food items mentioned. Ignore words in parentheses unless they are clearly food items.
+- "recipes": the exact recipe names mentioned.
+- "components": the individual food items or dish components of the recipes mentioned.
+Use an empty list when nothing is mentioned. Do not add any other items. Do not explain. Do not guess.
+
+Text: "{user_input}"
+"""
+
+
+def clean_items(items):
+    # Keep the first line of each item, without empty and 'NONE' items or
+    # duplicates
+    cleaned = []
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, str):
+            continue
+        item = item.strip().split("\n")[0].strip()
+        if item and item.upper() != "NONE" and item not in cleaned:
+            cleaned.append(item)
+    return cleaned
+
+
+def parse_extraction(content, user_input):
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError as e:
+        logger.error("Failed to parse extraction result %r: %s", content, e)
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+
+    intent = data.get("intent")
+    if intent not in INTENTS:
+        intent = "general"
+    # An explicit mention of a recipe always counts as a recipe request
+    if "recipe" in user_input.lower():
+        intent = "recipe"
+
+    return {
+        "intent": intent,
+        "foods": clean_items(data.get("foods")),
+        "recipes": clean_items(data.get("recipes")),
+        "components": clean_items(data.get("components")),
+    }
+
+
+def extraction_stats():
+    total = stats["fast_path"] + stats["cache"] + stats["model"]
+    return {
+        "fast_path": stats["fast_path"],
+        "cache": stats["cache"],
+        "model": stats["model"],
+        "fast_path_rate": stats["fast_path"] / total if total else 0.0,
+    }
+
+
+async def extract(user_input, cache=None):
+    # Foods, recipe names, dish components and intent of the message. Plain
+    # messages whose foods are all in the dictionaries skip the model call,
+    # and so do messages whose model extraction is in the cache.
+    extraction = food_matcher.get_matcher().match(user_input)
+    if extraction is not None:
+        stats["fast_path"] += 1
+        logger.info("Extraction (fast path): %s", extraction)
+        return extraction
+
+    if cache is not None:
+        key = cache.key_for("extraction", user_input, EXTRACTION_MODEL, PROMPT_VERSION)
+        extraction = await cache.get(key)
+        if extraction is not None:
+            stats["cache"] += 1
+            logger.info("Extraction (cached): %s", extraction)
+            return extraction
+
+    stats["model"] += 1
+    prompt = EXTRACTION_PROMPT.format(user_input=user_input)
+    response = await client.chat(
+        model=EXTRACTION_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        format=EXTRACTION_SCHEMA,
+        options={"temperature": 0},
+    )
+    extraction = parse_extraction(response["message"]["content"], user_input)
+    logger.info("Extraction: %s", extraction)
+    if cache is not None:
+        await cache.set(key, extraction)
+    return extraction
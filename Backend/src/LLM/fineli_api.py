@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import os
+import dotenv
+import httpx
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+FINELI_API_URL = os.getenv("FINELI_API_URL", "https://fineli.fi/fineli/api/v1")
+FINELI_TIMEOUT = float(os.getenv("FINELI_TIMEOUT", "5"))  # seconds
+# Most requests sent to Fineli at once, per worker
+FINELI_MAX_CONCURRENCY = int(os.getenv("FINELI_MAX_CONCURRENCY", "4"))
+# Extra attempts for timeouts, connection errors and retryable statuses
+FINELI_RETRIES = int(os.getenv("FINELI_RETRIES", "2"))
+FINELI_BACKOFF = float(os.getenv("FINELI_BACKOFF", "0.25"))  # seconds
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class FineliClient:
+    """
+    Pooled async client for the Fineli food API.
+
+    Connections are kept alive between requests, at most max_concurrency
+    requests are in flight at once, and failed requests are retried with
+    exponential backoff.
+    """
+
+    def __init__(
+        self,
+        base_url=FINELI_API_URL,
+        timeout=FINELI_TIMEOUT,
+        max_concurrency=FINELI_MAX_CONCURRENCY,
+        retries=FINELI_RETRIES,
+        backoff=FINELI_BACKOFF,
+    ):
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=timeout,
+            headers={"User-Agent": USER_AGENT},
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_concurrency,
+            ),
+        )
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.retries = retries
+        self.backoff = backoff
+
+    async def get_food(self, food_id):
+        # Nutrients of one food, raises httpx.HTTPError once retries run out
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    response = await self.client.get(f"/foods/{food_id}")
+                    if response.status_code not in RETRY_STATUSES:
+                        break
+                    error = httpx.HTTPStatusError(
+                        f"Fineli returned {response.status_code}",
+                        request=response.request,
+                        response=response,
+                    )
+                except httpx.TransportError as e:
+                    error = e
+                if attempt == self.retries:
+                    raise error
+                logger.warning(
+                    "Fineli request for %s failed (%s), retrying", food_id, error
+                )
+                await asyncio.sleep(self.backoff * 2**attempt)
+
+        response.raise_for_status()
+        data = response.json()
+        # Get the data from Fineli API and sort it out
+        return {
+            "Calories": data.get("energyKcal", "N/A"),
+            "Protein": data.get("protein", "N/A"),
+            "Fat": data.get("fat", "N/A"),
+            "Carbohydrates": data.get("carbohydrate", "N/A"),
+            "Fiber": data.get("fiber", "N/A"),
+        }
+
+    async def get_foods(self, food_ids):
+        # Nutrients or the raised exception for each distinct food id
+        food_ids = list(dict.fromkeys(food_ids))
+        results = await asyncio.gather(
+            *(self.get_food(food_id) for food_id in food_ids), return_exceptions=True
+        )
+        return dict(zip(food_ids, results))
+
+    async def aclose(self):
+        await self.client.aclose()
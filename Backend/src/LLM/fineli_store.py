@@ -0,0 +1,165 @@
+"""
+Local copy of the Fineli nutrient values used by the chat service.
+
+The store is a small SQLite file indexed by FOODID, built from the Fineli
+open data package. Each gunicorn worker reads it into memory once. Build or
+refresh it with:
+
+    python fineli_store.py refresh path/to/component_value.csv
+
+The source can also be the downloaded Fineli zip package or a URL to it.
+'make fineli' builds it from the component_value.csv of the recognition
+service. Until a worker finds a store, it fetches nutrients from the Fineli
+API instead.
+"""
+
+import argparse
+import csv
+import io
+import logging
+import os
+import sqlite3
+import zipfile
+from functools import lru_cache
+import dotenv
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+FINELI_DB = os.getenv(
+    "FINELI_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fineli.db")
+)
+
+# Fineli EUFDNAME codes and the keys they are returned under
+COMPONENTS = {
+    "ENERC": "Calories",
+    "PROT": "Protein",
+    "FAT": "Fat",
+    "CHOAVL": "Carbohydrates",
+    "FIBC": "Fiber",
+}
+# Energy is given in kJ. recognition/nutrients.py converts it the same way.
+KJ_PER_KCAL = 4.184
+
+
+def read_component_values(source):
+    # Accepts component_value.csv itself or the Fineli zip package, from a
+    # local path or a URL
+    if source.startswith("http://") or source.startswith("https://"):
+        import requests
+
+        response = requests.get(source, timeout=60)
+        response.raise_for_status()
+        data = response.content
+    else:
+        with open(source, "rb") as file:
+            data = file.read()
+
+    if zipfile.is_zipfile(io.BytesIO(data)):
+        with zipfile.ZipFile(io.BytesIO(data)) as package:
+            names = [
+                name
+                for name in package.namelist()
+                if os.path.basename(name).lower() == "component_value.csv"
+            ]
+            if not names:
+                raise ValueError(f"No component_value.csv in {source}")
+            data = package.read(names[0])
+
+    text = io.StringIO(data.decode("ISO-8859-1"))
+    nutrients = {}
+    for row in csv.reader(text, delimiter=";"):
+        if len(row) < 3 or row[1] not in COMPONENTS:
+            continue
+        value = float(row[2].replace(",", "."))
+        if row[1] == "ENERC":
+            value = value / KJ_PER_KCAL
+        # Components Fineli has no value for stay None, stored as NULL
+        food = nutrients.setdefault(int(row[0]), dict.fromkeys(COMPONENTS))
+        food[row[1]] = value
+    return nutrients
+
+
+def build_store(source, db_path=FINELI_DB):
+    nutrients = read_component_values(source)
+
+    # Workers open the store by path at startup, so a refresh must not
+    # write into the file in place. os.replace gives them the old store or
+    # the new one, never a mix.
+    tmp_path = f"{db_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        with connection:
+            connection.execute(
+                "CREATE TABLE nutrients (food_id INTEGER PRIMARY KEY, "
+                "energy_kcal REAL, protein REAL, fat REAL, carbohydrate REAL, "
+                "fiber REAL)"
+            )
+            connection.executemany(
+                "INSERT INTO nutrients VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (food_id, *(values[code] for code in COMPONENTS))
+                    for food_id, values in nutrients.items()
+                ],
+            )
+    finally:
+        connection.close()
+    os.replace(tmp_path, db_path)
+    return len(nutrients)
+
+
+@lru_cache(maxsize=None)
+def load_store(db_path=FINELI_DB):
+    if not os.path.exists(db_path):
+        logger.warning(
+            "Fineli store %s not found, using the Fineli API until "
+            "'python fineli_store.py refresh' has built it and the service "
+            "is restarted",
+            db_path,
+        )
+        return {}
+
+    connection = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = connection.execute("SELECT * FROM nutrients").fetchall()
+    finally:
+        connection.close()
+    return {row[0]: dict(zip(COMPONENTS.values(), row[1:])) for row in rows}
+
+
+def is_available(db_path=FINELI_DB):
+    return bool(load_store(db_path))
+
+
+def get_nutrients(food_id, db_path=FINELI_DB):
+    # Same shape as the Fineli API based lookup, or None if the food is not
+    # in the store
+    try:
+        food_id = int(food_id)
+    except (TypeError, ValueError):
+        return None
+    nutrients = load_store(db_path).get(food_id)
+    return dict(nutrients) if nutrients else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the local Fineli store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    refresh = subparsers.add_parser("refresh", help="Rebuild the store")
+    refresh.add_argument(
+        "source",
+        nargs="?",
+        default=os.getenv("FINELI_DATA_SOURCE"),
+        help="component_value.csv, the Fineli zip package, or a URL to either "
+        "(defaults to FINELI_DATA_SOURCE)",
+    )
+    refresh.add_argument("--db", default=FINELI_DB, help="Store file to write")
+    args = parser.parse_args()
+
+    if not args.source:
+        parser.error("a source is required when FINELI_DATA_SOURCE is not set")
+    count = build_store(args.source, args.db)
+    print(f"Stored nutrient values for {count} foods in {args.db}")
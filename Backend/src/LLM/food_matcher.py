@@ -0,0 +1,163 @@
+import csv
+import os
+import re
+from functools import lru_cache
+import dotenv
+
+dotenv.load_dotenv()
+
+# Share of the message's words that the dictionaries must explain before
+# the model call is skipped. Any unexplained word may be a food the
+# dictionaries do not know, so by default every word has to be explained.
+FAST_PATH_MIN_COVERAGE = float(os.getenv("FAST_PATH_MIN_COVERAGE", "1.0"))
+
+WORD_PATTERN = re.compile(r"[a-z]+|\d+(?:[.,]\d+)?")
+NUMBER_PATTERN = re.compile(r"\d")
+
+# Words that can appear around foods without changing what was eaten or
+# asked for. They are never matched as foods themselves.
+FILLER_WORDS = {
+    "a", "about", "after", "also", "am", "an", "and", "any", "are", "as",
+    "at", "ate", "be", "before", "bit", "bowl", "breakfast", "brunch",
+    "calories", "can", "contain", "cook", "couple", "cup", "day", "did",
+    "dinner", "do", "does", "drank", "drink", "eat", "eaten", "eating",
+    "evening", "few", "find", "for", "from", "g", "gave", "give", "glass",
+    "got", "grams", "had", "half", "handful", "have", "having", "how", "i",
+    "in", "is", "it", "just", "kg", "l", "like", "little", "lot", "lunch",
+    "m", "make", "many", "me", "meal", "ml", "morning", "much", "my", "need",
+    "nutrients", "nutrition", "of", "on", "one", "or", "pieces", "plate",
+    "please", "portion", "protein", "recipe", "recipes", "serving", "show",
+    "slices", "snack", "so", "some", "spoon", "tablespoon", "teaspoon",
+    "that", "the", "there", "these", "this", "three", "to", "today",
+    "tonight", "two", "values", "want", "was", "what", "which", "with",
+    "would", "yesterday", "you",
+}  # fmt: skip
+
+
+def singular(word):
+    # Fold common English plural forms, so "eggs" and "berries" match the
+    # dictionary entries "egg" and "berry"
+    if len(word) <= 3 or word.endswith("ss"):
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("oes", "sses", "ches", "shes", "xes")):
+        return word[:-2]
+    if word.endswith("s"):
+        return word[:-1]
+    return word
+
+
+def normalize(text):
+    return [singular(word) for word in WORD_PATTERN.findall(text.lower())]
+
+
+FILLER = {singular(word) for word in FILLER_WORDS}
+
+
+class PhraseMatcher:
+    """
+    Word-level trie over normalised dictionary phrases.
+
+    Scanning a message finds the leftmost-longest phrase at each position,
+    so "apple juice" wins over "apple" and matches never overlap.
+    """
+
+    def __init__(self, phrases):
+        self.root = {}
+        for phrase in phrases:
+            words = normalize(phrase)
+            if not words or (len(words) == 1 and words[0] in FILLER):
+                continue
+            node = self.root
+            for word in words:
+                node = node.setdefault(word, {})
+            # Keep the first spelling seen for a phrase
+            node.setdefault(None, phrase)
+
+    def scan(self, words):
+        # (start, end, phrase) for every match in the normalised words
+        matches = []
+        start = 0
+        while start < len(words):
+            node = self.root
+            match = None
+            for end in range(start, len(words)):
+                node = node.get(words[end])
+                if node is None:
+                    break
+                if None in node:
+                    match = (start, end + 1, node[None])
+            if match:
+                matches.append(match)
+                start = match[1]
+            else:
+                start += 1
+        return matches
+
+
+class FoodMatcher:
+    """
+    Dictionary fast path for food extraction.
+
+    Foods are the Fineli food names (the part before the first comma, e.g.
+    "APPLE" from "APPLE, DRIED") and recipes are the allrecipes.csv names.
+    A message is handled without the model when every food it mentions is
+    in the dictionaries, i.e. when matched phrases, filler words and
+    quantities cover enough of its words.
+    """
+
+    def __init__(self, food_names, recipe_names):
+        self.foods = PhraseMatcher(
+            name.split(",")[0].strip().lower() for name in food_names
+        )
+        self.recipes = PhraseMatcher(name.lower() for name in recipe_names)
+
+    @classmethod
+    def from_csv(cls, food_csv, recipe_csv):
+        with open(food_csv, mode="r", encoding="ISO-8859-1") as file:
+            food_names = [
+                row["FOODNAME"] for row in csv.DictReader(file, delimiter=";")
+            ]
+        with open(recipe_csv, "r", encoding="ISO-8859-1") as file:
+            recipe_names = [row["name"] for row in csv.DictReader(file)]
+        return cls(food_names, recipe_names)
+
+    def match(self, user_input, min_coverage=FAST_PATH_MIN_COVERAGE):
+        # The extraction result for the message, or None when the model is
+        # needed
+        words = normalize(user_input)
+        if not words:
+            return None
+
+        covered = [word in FILLER or bool(NUMBER_PATTERN.match(word)) for word in words]
+        recipes = []
+        for start, end, phrase in self.recipes.scan(words):
+            recipes.append(phrase)
+            covered[start:end] = [True] * (end - start)
+        foods = []
+        for start, end, phrase in self.foods.scan(words):
+            if phrase not in foods:
+                foods.append(phrase)
+            covered[start:end] = [True] * (end - start)
+
+        if not foods and not recipes:
+            return None
+        if sum(covered) / len(words) < min_coverage:
+            return None
+
+        if "recipe" in user_input.lower():
+            return {
+                "intent": "recipe",
+                "foods": foods,
+                "recipes": list(dict.fromkeys(recipes)),
+                "components": foods,
+            }
+        if recipes or not foods:
+            return None
+        return {"intent": "nutrition", "foods": foods, "recipes": [], "components": []}
+
+
+@lru_cache(maxsize=None)
+def get_matcher(food_csv="foodname_EN.csv", recipe_csv="allrecipes.csv"):
+    return FoodMatcher.from_csv(food_csv, recipe_csv)
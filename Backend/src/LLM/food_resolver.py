@@ -0,0 +1,77 @@
+import csv
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+
+class FoodNameResolver:
+    """
+    Prebuilt lookup structures over the Fineli food names (foodname_EN.csv).
+
+    Resolves a name the same way as the old pandas scans: an exact match
+    first, then a name starting with it, then a name containing it, taking
+    the first row of the file in each case. Matching is case-sensitive and
+    literal.
+    """
+
+    def __init__(self, rows):
+        self.food_ids = [food_id for food_id, _ in rows]
+        names = [food_name for _, food_name in rows]
+
+        # Exact matches: name -> row of its first occurrence
+        self.exact = {}
+        for row, name in enumerate(names):
+            self.exact.setdefault(name, row)
+
+        # Prefix matches: names sorted for bisect, with their original rows
+        order = sorted(range(len(names)), key=lambda row: names[row])
+        self.sorted_names = [names[row] for row in order]
+        self.sorted_rows = order
+
+        # Substring matches: every name joined into one string, so the first
+        # str.find hit is in the earliest row containing the text
+        self.haystack = "\n".join(names)
+        self.offsets = []
+        offset = 0
+        for name in names:
+            self.offsets.append(offset)
+            offset += len(name) + 1
+
+    @classmethod
+    def from_csv(cls, csv_file):
+        with open(csv_file, mode="r", encoding="ISO-8859-1") as file:
+            reader = csv.DictReader(file, delimiter=";")
+            rows = [(int(row["FOODID"]), row["FOODNAME"]) for row in reader]
+        return cls(rows)
+
+    def find_prefix(self, food_name):
+        start = bisect_left(self.sorted_names, food_name)
+        end = bisect_right(self.sorted_names, food_name + "\U0010ffff", lo=start)
+        if start == end:
+            return None
+        return min(self.sorted_rows[start:end])
+
+    def find_substring(self, food_name):
+        if "\n" in food_name:
+            return None
+        position = self.haystack.find(food_name)
+        if position == -1:
+            return None
+        return bisect_right(self.offsets, position) - 1
+
+    def resolve(self, food_name):
+        row = self.exact.get(food_name)
+        if row is None:
+            row = self.find_prefix(food_name)
+        if row is None:
+            row = self.find_substring(food_name)
+        return None if row is None else self.food_ids[row]
+
+    def resolve_many(self, food_names):
+        # Resolve a whole food list at once, looking up repeated names once
+        resolved = {name: self.resolve(name) for name in dict.fromkeys(food_names)}
+        return [resolved[name] for name in food_names]
+
+
+@lru_cache(maxsize=None)
+def get_resolver(csv_file="foodname_EN.csv"):
+    return FoodNameResolver.from_csv(csv_file)
@@ -0,0 +1,210 @@
+"""
+Storage for the images users send with their chat messages.
+
+Images are stored once, named by the SHA-256 of their bytes, and chat
+history entries only keep that name as image_id. They live in the
+chat_images GridFS bucket of the NutriVision database, or in a local
+directory when IMAGE_STORE_DIR is set, which is handy for tests. Chats
+that still hold image bytes in their history entries are moved over with:
+
+    python image_store.py migrate
+
+Deleting a chat leaves its images behind, since other chats may share
+them. Images no chat refers to any more are removed with:
+
+    python image_store.py prune
+"""
+
+import argparse
+import asyncio
+import hashlib
+import os
+import time
+from datetime import datetime, timezone
+import dotenv
+from gridfs import AsyncGridFSBucket
+from gridfs.errors import FileExists, NoFile
+import mongo
+
+dotenv.load_dotenv()
+
+# Local directory to store images in instead of GridFS, empty for GridFS
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "")
+IMAGE_BUCKET = "chat_images"
+# Images are stored before the reply they belong to is saved, so prune only
+# removes images older than this
+PRUNE_MIN_AGE = 3600  # seconds
+
+
+def image_id_for(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class GridFSImageStore:
+    """
+    Images in a GridFS bucket, with the image id as the file id.
+    """
+
+    def __init__(self, db, bucket_name=IMAGE_BUCKET):
+        self.files = db[f"{bucket_name}.files"]
+        self.bucket = AsyncGridFSBucket(db, bucket_name=bucket_name)
+
+    async def put(self, data):
+        image_id = image_id_for(data)
+        if await self.files.find_one({"_id": image_id}, {"_id": 1}):
+            return image_id
+        try:
+            await self.bucket.upload_from_stream_with_id(image_id, image_id, data)
+        except FileExists:
+            # Another request stored the same image first
+            pass
+        return image_id
+
+    async def get(self, image_id):
+        try:
+            stream = await self.bucket.open_download_stream(image_id)
+        except NoFile:
+            return None
+        return await stream.read()
+
+    async def ids(self, stored_before):
+        # Ids of the images stored before the given time
+        uploaded = datetime.fromtimestamp(stored_before, timezone.utc)
+        return {
+            file["_id"]
+            async for file in self.files.find(
+                {"uploadDate": {"$lt": uploaded}}, {"_id": 1}
+            )
+        }
+
+    async def delete(self, image_id):
+        try:
+            await self.bucket.delete(image_id)
+        except NoFile:
+            pass
+
+
+class LocalImageStore:
+    """
+    Images as files in a directory, in subdirectories named by the first
+    two characters of the image id.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path_for(self, image_id):
+        return os.path.join(self.root, image_id[:2], image_id)
+
+    def _write(self, image_id, data):
+        path = self.path_for(image_id)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The file name claims the hash of the whole image, and put() skips
+        # existing files, so a partial file must never appear under it
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def _read(self, image_id):
+        try:
+            with open(self.path_for(image_id), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    async def put(self, data):
+        image_id = image_id_for(data)
+        await asyncio.to_thread(self._write, image_id, data)
+        return image_id
+
+    async def get(self, image_id):
+        return await asyncio.to_thread(self._read, image_id)
+
+    def _ids(self, stored_before):
+        if not os.path.isdir(self.root):
+            return set()
+        return {
+            name
+            for directory in os.listdir(self.root)
+            for name in os.listdir(os.path.join(self.root, directory))
+            if not name.endswith(".tmp")
+            and os.path.getmtime(self.path_for(name)) < stored_before
+        }
+
+    async def ids(self, stored_before):
+        # Ids of the images stored before the given time
+        return await asyncio.to_thread(self._ids, stored_before)
+
+    async def delete(self, image_id):
+        try:
+            os.remove(self.path_for(image_id))
+        except FileNotFoundError:
+            pass
+
+
+def get_image_store(db, store_dir=IMAGE_STORE_DIR):
+    if store_dir:
+        return LocalImageStore(store_dir)
+    return GridFSImageStore(db)
+
+
+async def migrate(chat_collection, store):
+    # Move image bytes out of history entries, one entry at a time. Entries
+    # are only ever appended, so their positions stay valid while the chat
+    # service keeps running.
+    chats = moved = 0
+    async for chat in chat_collection.find(
+        {"history.image": {"$type": "binData"}}, {"history.image": 1}
+    ):
+        chats += 1
+        for index, entry in enumerate(chat.get("history", [])):
+            if entry.get("image") is None:
+                continue
+            image_id = await store.put(bytes(entry["image"]))
+            await chat_collection.update_one(
+                {"_id": chat["_id"]},
+                {
+                    "$set": {f"history.{index}.image_id": image_id},
+                    "$unset": {f"history.{index}.image": ""},
+                },
+            )
+            moved += 1
+    return chats, moved
+
+
+async def prune(chat_collection, store):
+    # Remove stored images that no chat refers to
+    stored = await store.ids(time.time() - PRUNE_MIN_AGE)
+    referenced = set(await chat_collection.distinct("history.image_id"))
+    unused = stored - referenced
+    for image_id in unused:
+        await store.delete(image_id)
+    return len(unused)
+
+
+async def main(command):
+    client = mongo.create_client(timeout_ms=None)
+    try:
+        db = client[mongo.DATABASE]
+        store = get_image_store(db)
+        if command == "migrate":
+            chats, moved = await migrate(db["chat_history"], store)
+            print(f"Moved {moved} images out of {chats} chats")
+        else:
+            print(f"Removed {await prune(db['chat_history'], store)} unused images")
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the chat image store")
+    parser.add_argument(
+        "command",
+        choices=["migrate", "prune"],
+        help="Move images out of chat documents, or remove unused images",
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.command))
@@ -0,0 +1,89 @@
+"""
+Image preprocessing shared by the recognition and LLM services.
+
+Phone photos are decoded once, rotated according to their EXIF
+orientation, downscaled to IMAGE_MAX_EDGE and re-encoded before they are
+sent to Clarifai or stored in MongoDB.
+
+Each service is built from its own directory, so recognition/imageprep.py
+and LLM/imageprep.py are copies of each other. Change them together.
+"""
+
+import io
+import logging
+import os
+from typing import NamedTuple
+from PIL import ExifTags, Image, ImageOps, UnidentifiedImageError
+import dotenv
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1024"))  # pixels
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()  # JPEG or WEBP
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+
+CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+class ImageTooLarge(ValueError):
+    """
+    The image has more pixels than Pillow is willing to decode.
+    """
+
+
+class PreparedImage(NamedTuple):
+    data: bytes
+    content_type: str
+    original_bytes: int
+    prepared_bytes: int
+
+
+def prepare_image(
+    image_bytes,
+    max_edge=IMAGE_MAX_EDGE,
+    image_format=IMAGE_FORMAT,
+    quality=IMAGE_QUALITY,
+):
+    original_bytes = len(image_bytes)
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            original_format = image.format
+            original_size = image.size
+            orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+            # Let the JPEG decoder scale down while decoding instead of
+            # decoding the full resolution and resizing afterwards
+            image.draft("RGB", (max_edge, max_edge))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            buffer = io.BytesIO()
+            image.save(buffer, format=image_format, quality=quality)
+    except Image.DecompressionBombError as e:
+        # Not an OSError. Passing such an image on as is would only move the
+        # problem to whoever decodes it next.
+        raise ImageTooLarge(str(e)) from e
+    except (UnidentifiedImageError, OSError) as e:
+        logger.warning(f"Could not preprocess image, using it as is: {e}")
+        return PreparedImage(
+            bytes(image_bytes),
+            "application/octet-stream",
+            original_bytes,
+            original_bytes,
+        )
+
+    data = buffer.getvalue()
+    unchanged = (
+        orientation == 1
+        and image.size == original_size
+        and original_format == image_format
+    )
+    if unchanged and len(data) >= original_bytes:
+        # Already small enough, re-encoding would only lose quality
+        data = bytes(image_bytes)
+    logger.info(f"Prepared image: {original_bytes} -> {len(data)} bytes")
+    return PreparedImage(
+        data, CONTENT_TYPES.get(image_format, "image/jpeg"), original_bytes, len(data)
+    )
@@ -1,20 +1,33 @@
+import ast
+import asyncio
 import ollama
 import os
 import json
-import pandas
-import requests
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from pymongo import MongoClient
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pymongo.errors import DuplicateKeyError
+from starlette.datastructures import UploadFile
 from datetime import datetime
-from bson import Binary
 import base64
 import filetype
 from datetime import timezone
-import csv
 import dotenv
 
 import logging
+import imageprep
+import fineli_store
+import food_resolver
+import food_matcher
+import recipe_index
+import extraction
+import semantic_index
+import image_store
+import mongo
+import context_builder
+from fineli_api import FineliClient
+from prompt_cache import PromptCache
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -23,185 +36,201 @@ logging.basicConfig(
 
 dotenv.load_dotenv()
 
-# Set up Flask app
-app = Flask(__name__)
-CORS(app)
-
-# Set up MongoDB: user URI to connect, create new collection
 PRODUCTION = os.getenv("NODE_ENV") == "production"
-mongo_uri = os.environ.get("MONGODB_URI")
-client = MongoClient(mongo_uri)
-db = client["NutriVision"]
-chat_collection = db["chat_history"]
 
-food_data = pandas.read_csv("foodname_EN.csv", encoding="ISO-8859-1", delimiter=";")
+# MongoDB client, chat collection and image store of this worker, set up
+# when the worker starts (see lifespan)
+client = None
+db = None
+chat_collection = None
+# Chat images are stored once outside the chat documents (see image_store.py)
+images = None
+
+# Nutrients come from the local Fineli store (see fineli_store.py). The
+# Fineli API is used when there is no store, and for foods missing from it
+# when enabled.
+FINELI_REMOTE_FALLBACK = os.getenv("FINELI_REMOTE_FALLBACK", "false") == "true"
+# History entries returned by /chat_one per page, by default and at most
+CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", "20"))
+MAX_CHAT_PAGE_SIZE = 100
+# How long browsers may keep a chat image. Stored images never change.
+IMAGE_CACHE_MAX_AGE = int(os.getenv("IMAGE_CACHE_MAX_AGE", "86400"))  # seconds
+
+# Bump when the nutrition message format changes
+NUTRITION_MESSAGE_VERSION = 3
+
+# Extractions and nutrition messages of recent messages
+prompt_cache = PromptCache()
+
+ollama_client = ollama.AsyncClient()
+fineli_client = FineliClient()
+# Summary updates running after their reply was sent
+background_tasks = set()
+
+
+def preload():
+    # Build the lookup tables of this worker before it serves requests, so
+    # the first chats do not build them on the event loop
+    loaders = [
+        recipe_index.get_recipe_index,
+        food_matcher.get_matcher,
+        food_resolver.get_resolver,
+        fineli_store.load_store,
+        lambda: semantic_index.get_index("recipes"),
+        lambda: semantic_index.get_index("foods"),
+    ]
+    for load in loaders:
+        try:
+            load()
+        except FileNotFoundError as e:
+            logger.warning("Could not preload lookup data: %s", e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Connect once gunicorn has forked this worker, so no connection pool is
+    # shared between processes (see mongo.py)
+    global client, db, chat_collection, images
+    client = mongo.create_client()
+    db = client[mongo.DATABASE]
+    chat_collection = db["chat_history"]
+    images = image_store.get_image_store(db)
+    await mongo.ensure_indexes(chat_collection)
+    await asyncio.to_thread(preload)
+    yield
+    await fineli_client.aclose()
+    await client.close()
+
+
+# Set up the app. Each worker serves many chats at once, since every model
+# call, MongoDB query and Fineli request is awaited instead of blocking.
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 
 def get_food_id(food_name):
-    # Try to find the best match for a food in Fineli database
-    # Check for an exact match in the database
-    exact_match = food_data[food_data["FOODNAME"] == food_name]
-    if not exact_match.empty:
-        return exact_match.iloc[0]["FOODID"]
-
-    # Check for a match that starts with food name in database.
-    startswith_match = food_data[food_data["FOODNAME"].str.startswith(food_name)]
-    if not startswith_match.empty:
-        return startswith_match.iloc[0]["FOODID"]
-
-    # Check for a match that contains food name in database
-    contains_match = food_data[food_data["FOODNAME"].str.contains(food_name)]
-    if not contains_match.empty:
-        return contains_match.iloc[0]["FOODID"]
-
-    return "Food ID not found in database."
-
-
-def get_nutritional_values(food_name):
-    # Get food ID and fetch data from Fineli API
-    food_id = get_food_id(food_name)
-    if not food_id:
-        return f"Food '{food_name}' not found in database."
-
-    else:
-        url = f"https://fineli.fi/fineli/api/v1/foods/{food_id}"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
-        }
-        response = requests.get(url, headers=headers)
-
-        if response.status_code == 200:
-            data = response.json()
-            # Get the data from Fineli API and sort it out
-            return {
-                "Calories": data.get("energyKcal", "N/A"),
-                "Protein": data.get("protein", "N/A"),
-                "Fat": data.get("fat", "N/A"),
-                "Carbohydrates": data.get("carbohydrate", "N/A"),
-                "Fiber": data.get("fiber", "N/A"),
-            }
+    # Try to find the best match for a food in Fineli database: an exact
+    # match, then a name starting with it, then a name containing it
+    return food_resolver.get_resolver().resolve(food_name)
+
+
+async def get_food_ids(food_names):
+    # Resolve a whole food list in one call. With SEMANTIC_FOOD_MATCHES,
+    # names without a literal match fall back to the closest food in the
+    # semantic index. Returns the ids and the Fineli name of each such
+    # approximate match.
+    food_ids = food_resolver.get_resolver().resolve_many(food_names)
+    missing = [name for name, food_id in zip(food_names, food_ids) if food_id is None]
+    approximate = {}
+    if missing and semantic_index.SEMANTIC_FOOD_MATCHES:
+        similar = dict(zip(missing, await semantic_index.similar_foods(missing)))
+        approximate = {name: match[1] for name, match in similar.items() if match}
+        food_ids = [
+            similar[name][0] if name in approximate else food_id
+            for name, food_id in zip(food_names, food_ids)
+        ]
+    return food_ids, approximate
+
+
+async def get_nutritional_values_many(food_names):
+    # Nutrients for each food name, in the same order. Repeated names are
+    # looked up once, and foods missing from the local store are fetched
+    # from the Fineli API concurrently.
+    names = list(dict.fromkeys(food_names))
+    results = {}
+    remote = {}
+    food_ids, approximate = await get_food_ids(names)
+    for food_name, food_id in zip(names, food_ids):
+        nutrients = fineli_store.get_nutrients(food_id) if food_id else None
+        if nutrients is not None:
+            results[food_name] = nutrients
+        elif food_id and (FINELI_REMOTE_FALLBACK or not fineli_store.is_available()):
+            remote[food_name] = food_id
         else:
-            return f"Error fetching data for {food_name}."
-
-
-def sort_foods_input(user_input):
-    # Give prompt for the model to sort out foods from the user input
-    prompt = f"""
-    Carefully read the following text and extract only the food items explicitly mentioned.
-    Return ONLY a comma-separated list of the exact food items found in the text.
-    Ignore words in parentheses unless they are clearly food items.
-    If no food items are mentioned, return an empty string.
-    Do not add any other items. Do not explain. Do not guess.
-
-    Text: "{user_input}"
-    """
-    response = ollama.chat(
-        model="llama3.1", messages=[{"role": "user", "content": prompt}]
-    )
-    sorted_foods = response.get("message", []).get("content", "").strip()
-
-    # Separate potential foods by comma
-    potential_foods_comma_split = sorted_foods.split(",")
-    processed_foods = set()
-    food_list = []
-
-    # For each potential food item in potential_food_comma_split, clean the item and make sure there is no '\n' or 'NONE' text
-    for item in potential_foods_comma_split:
-        cleaned_item = item.strip()
+            results[food_name] = f"Food '{food_name}' not found in database."
+
+    fetched = await fineli_client.get_foods(remote.values()) if remote else {}
+    for food_name, food_id in remote.items():
+        nutrients = fetched[food_id]
+        if isinstance(nutrients, Exception):
+            logger.error("Error fetching Fineli data for %s: %s", food_name, nutrients)
+            nutrients = f"Error fetching data for {food_name}."
+        results[food_name] = nutrients
+
+    # Say which food the numbers of an approximate match are for
+    for food_name, fineli_name in approximate.items():
+        if isinstance(results[food_name], dict):
+            results[food_name] = {
+                **results[food_name],
+                "Approximate match": fineli_name,
+            }
 
-        if "\n" in cleaned_item:
-            cleaned_item = cleaned_item.split("\n")[0].strip()
+    return [results[food_name] for food_name in food_names]
 
-        if cleaned_item and cleaned_item.upper() != "NONE":
-            processed_foods.add(cleaned_item)
 
-    # Return food list with cleaned food items
-    food_list = list(processed_foods)
-    logger.info(f"FOOD_LIST: {food_list}")
-    return food_list
+def format_amount(value, unit):
+    # Fineli has no value for some components of some foods
+    if isinstance(value, (int, float)):
+        return f"{value:.3f} {unit}"
+    return "N/A"
 
 
-def get_recipe_names(input):
-    recipe_names = []
-    with open("allrecipes.csv", "r", encoding="ISO-8859-1") as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            if input.lower() in row["name"].lower():
-                recipe_names.append(row["name"])
-    return recipe_names
+async def get_nutritional_values(food_name):
+    return (await get_nutritional_values_many([food_name]))[0]
 
 
-def get_individual_recipes_names(input):
+def get_recipe_names(names):
+    # Recipes whose name contains any of the given names or dish components
     recipe_names = []
-    with open("allrecipes.csv", "r", encoding="ISO-8859-1") as file:
-        if "," in input:
-            for item in input.split(","):
-                file.seek(0)
-                reader = csv.DictReader(file)
-                for row in reader:
-                    if item.strip().lower() in row["name"].lower():
-                        recipe_names.append(row["name"])
+    index = recipe_index.get_recipe_index()
+    for name in names:
+        recipe_names.extend(index.search_names(name))
     return recipe_names
 
 
-def get_recipes_details(names):
-    recipe_details = []
-    with open("allrecipes.csv", "r", encoding="ISO-8859-1") as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            if row["name"] in names:
-                recipe_details.append(
-                    {
-                        "name": row["name"],
-                        "ingredients": row["ingredient"],
-                        "process": row["process"],
-                    }
-                )
-    return recipe_details
-
+def get_recipes_details(names, query=None):
+    # Only the recipes that best match the query go into the prompt
+    return recipe_index.get_recipe_index().details(
+        names, query, recipe_index.MAX_PROMPT_RECIPES
+    )
 
-def filter_recipes(input):
-    prompt = f"""
-    Carefully read the following text and extract only the recipe name explicitly mentioned.
-    Return ONLY the exact recipe name, 
-    or a comma-separated list of the exact recipe names if multiple recipe names are found in the text.
-    If no recipe names are mentioned, return an empty string.
-    Do not add any other items. Do not explain. Do not guess.
 
-    Text: {input}
-    """
-    response = ollama.chat(
-        model="llama3.1", messages=[{"role": "user", "content": prompt}]
-    )
-    return response["message"]["content"].strip()
+async def store_image(image):
+    # Downscale the image off the event loop and store it, returning the id
+    # the history entry refers to it by
+    if not image:
+        return None
+    prepared = await asyncio.to_thread(imageprep.prepare_image, await image.read())
+    return await images.put(prepared.data)
 
 
-def filter_individual_recipes(input):
-    prompt = f"""
-    Carefully read the following text and extract only the individual food items or dish components mentioned in the input, if any.
-    Return only a comma-separated list of the exact individual recipe names if any individual recipe names are found in the text.
-    If no individual recipe names are mentioned, return an empty string.
-    Do not add any other items. Do not explain. Do not guess.
+async def get_extraction(user_input):
+    # One model call extracts foods, recipe names and intent for both the
+    # nutrition lookup and the prompt
+    extracted = await extraction.extract(user_input, prompt_cache)
+    return extracted, await get_nutrition_message(extracted)
 
-    Text: {input}
-    """
-    response = ollama.chat(
-        model="llama3.1", messages=[{"role": "user", "content": prompt}]
-    )
-    return response["message"]["content"].strip()
 
+async def prepare_chat(request):
+    # Everything the chat endpoints do before generating the reply. Returns
+    # the chat context, or an error response for an invalid request.
 
-@app.route("/chat", methods=["POST"])
-def chat_handler():
     # Get data from payload
-    data = request.form.to_dict(flat=True)
-    image_data = request.files.to_dict(flat=True)
+    form = await request.form()
+    data = {key: value for key, value in form.items() if isinstance(value, str)}
+    image = form.get("image")
+    if not isinstance(image, UploadFile):
+        image = None
 
     if not data:
-        return jsonify({"error": "Invalid request"}), 400
+        return None, JSONResponse({"error": "Invalid request"}, status_code=400)
 
     user_input = data.get("message", "")
-    image = image_data.get("image", None)
     image_result = data.get("imageRecognitionResult", None)
 
     healthConditions = data.get("healthConditions", None)
@@ -215,18 +244,10 @@ def chat_handler():
 
     if not user_id:
         logger.info("User ID is missing from the request")
-        return jsonify({"error": "Missing userId!"}), 400
+        return None, JSONResponse({"error": "Missing userId!"}, status_code=400)
 
     # Set up variables to save chat_history to MongoDB and send response for frontend
     image_result_info = ""
-    nutrition_message = ""
-    reply = ""
-
-    # Convert image as Binary
-    image_binary = None
-    if image:
-        image_bytes = image.read()
-        image_binary = Binary(image_bytes)
 
     logger.info(
         "Message: %s, UserID: %s, ChatID: %s, Image recoginition result: %s",
@@ -236,55 +257,45 @@ def chat_handler():
         image_result,
     )
 
+    # The history, the extraction with its nutrient lookups and the image
+    # preprocessing do not depend on each other, so run them concurrently
+    try:
+        (chat_history, pending_summary), (extracted, nutrition_message), image_id = (
+            await asyncio.gather(
+                context_builder.build_context(chat_collection, chat_id),
+                get_extraction(user_input),
+                store_image(image),
+            )
+        )
+    except imageprep.ImageTooLarge as e:
+        logger.info("Rejected image: %s", e)
+        return None, JSONResponse({"error": "Image is too large"}, status_code=413)
+
     # Prepare base history entry for saving data to MongoDB
     history_entry = {
         "user_message": user_input,
-        "image": image_binary,
+        "image_id": image_id,
         "image_result": "",
         "nutrition_message": "",
         "bot_message": "",
     }
 
-    # Fetch chat history from MongoDB
-    history_from_db = list(
-        chat_collection.find(
-            {"chat_id": chat_id}, {"history": {"$slice": -10}}
-        )  # Limit to 10 chats
-    )
-    # logger.info("History from DB: %s", history_from_db)
-
-    # Generate the base chat_history
-    chat_history = []
-
-    # Handle previous chat history fetched from MongoDB
-    if history_from_db and "history" in history_from_db[0]:
-        previous_history_items = history_from_db[0][
-            "history"
-        ]  # Access the history array
-        for item in previous_history_items:
-            if item.get("user_message"):
-                chat_history.append({"role": "user", "content": item["user_message"]})
-            if item.get("bot_message"):
-                chat_history.append(
-                    {"role": "assistant", "content": item["bot_message"]}
-                )
-
     # Process image recognition result
     if image_result:
         try:
-            json_compatible_str = image_result.replace("'", '"')
-            parsed_result = json.loads(json_compatible_str)
+            parsed_result = parse_image_result(image_result)
 
             if isinstance(parsed_result, list):
                 info_lines = []
                 for item in parsed_result:
                     name = item.get("name", "N/A")
                     confidence = item.get("confidence", 0.0)
-                    macros = item.get("macronutrients", {})
-                    kcal = macros.get("Kilocalories", "N/A")
-                    protein = macros.get("Protein", "N/A")
-                    carbs = macros.get("Carbohydrates", "N/A")
-                    fat = macros.get("Fat", "N/A")
+                    macros = item.get("macronutrients") or {}
+                    # Unknown values are null, or left out with compact=true
+                    kcal, protein, carbs, fat = (
+                        "N/A" if macros.get(key) is None else macros[key]
+                        for key in ("Kilocalories", "Protein", "Carbohydrates", "Fat")
+                    )
 
                     lines = [
                         f"{name} (confidence: {confidence:.4f})\n",
@@ -308,9 +319,7 @@ def chat_handler():
         except Exception as e:
             logger.error("Error processing image recognition result: ", e)
 
-    nutrition_message = get_nutrition_message(user_input)
-
-    prompt = get_prompt(
+    prompt = await get_prompt(
         image_result_info,
         chat_history,
         healthConditions,
@@ -320,83 +329,207 @@ def chat_handler():
         dislikedDishes,
         user_input,
         nutrition_message,
+        extracted,
     )
 
     logger.info("Prompt: %s", json.dumps(prompt, indent=2))
 
-    # Generate response
-    response = ollama.chat(model="nutrivision", messages=prompt)
-    reply = response["message"]["content"].strip()
+    chat = {
+        "chat_id": chat_id,
+        "user_input": user_input,
+        "history_entry": history_entry,
+        "prompt": prompt,
+        "image_result_info": image_result_info,
+        "nutrition_message": nutrition_message,
+        "pending_summary": pending_summary,
+    }
+    return chat, None
+
 
-    logger.info("User Message: %s", user_input)
-    logger.info("Nutrition message: %s", nutrition_message)
+async def save_reply(chat, reply):
+    logger.info("User Message: %s", chat["user_input"])
+    logger.info("Nutrition message: %s", chat["nutrition_message"])
     logger.info("Reply: %s", reply)
 
-    # Add reply to history_entry
+    # Add reply and nutrition message to history_entry
+    history_entry = chat["history_entry"]
     history_entry["bot_message"] = reply
-
-    # Add nutrition message to history_entry
-    history_entry["nutrition_message"] = nutrition_message
+    history_entry["nutrition_message"] = chat["nutrition_message"]
 
     # Update MongoDB history
-    chat_collection.update_one(
-        {"chat_id": chat_id}, {"$push": {"history": history_entry}}
+    await chat_collection.update_one(
+        {"chat_id": chat["chat_id"]}, {"$push": {"history": history_entry}}
     )
 
+    # Fold the turns that no longer fit the context into the chat summary
+    if chat["pending_summary"]:
+        task = asyncio.create_task(
+            context_builder.update_summary(
+                chat_collection, chat["chat_id"], chat["pending_summary"]
+            )
+        )
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+
+@app.post("/chat")
+async def chat_handler(request: Request):
+    chat, error = await prepare_chat(request)
+    if error:
+        return error
+
+    # Generate response
+    response = await ollama_client.chat(model="nutrivision", messages=chat["prompt"])
+    reply = response["message"]["content"].strip()
+    await save_reply(chat, reply)
+
     # Send response for frontend
-    return jsonify(
+    return JSONResponse(
         {
             "response": reply,
-            "image_result": image_result_info,
-            "nutrition_message": nutrition_message,
+            "image_result": chat["image_result_info"],
+            "nutrition_message": chat["nutrition_message"],
         }
     )
 
 
-def get_nutrition_message(user_input):
-    # Extract food info from user input
-    food_list = sort_foods_input(user_input)
+def stream_event(event_type, **fields):
+    return json.dumps({"type": event_type, **fields}) + "\n"
+
+
+@app.post("/chat/stream")
+async def chat_stream_handler(request: Request):
+    # Same as /chat, but the reply is streamed as newline-delimited JSON: a
+    # "metadata" event with the image and nutrition results, "token" events
+    # as the model generates, then "done" with the whole reply. The history
+    # is saved once the reply is complete.
+    chat, error = await prepare_chat(request)
+    if error:
+        return error
+
+    async def generate():
+        yield stream_event(
+            "metadata",
+            image_result=chat["image_result_info"],
+            nutrition_message=chat["nutrition_message"],
+        )
+        tokens = []
+        try:
+            async for chunk in await ollama_client.chat(
+                model="nutrivision", messages=chat["prompt"], stream=True
+            ):
+                token = chunk["message"]["content"]
+                if token:
+                    tokens.append(token)
+                    yield stream_event("token", content=token)
+        except Exception as e:
+            logger.error("Error streaming reply: %s", e)
+            yield stream_event("error", error="Failed to generate a reply")
+            return
+
+        reply = "".join(tokens).strip()
+        await save_reply(chat, reply)
+        yield stream_event("done", response=reply)
+
+    return StreamingResponse(
+        generate(),
+        media_type="application/x-ndjson",
+        # Keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def parse_image_result(image_result):
+    # /recognize returns a JSON list of recognized items. Older clients may
+    # still send the Python repr that it used to return, so fall back to
+    # reading that as a literal.
+    try:
+        return json.loads(image_result)
+    except json.JSONDecodeError as json_err:
+        try:
+            return ast.literal_eval(image_result)
+        except (ValueError, SyntaxError):
+            raise json_err
+
+
+async def get_nutrition_message(extracted):
+    # Food items extracted from the user input
+    food_list = extracted["foods"]
     # If no image or recipe detected, treat as a text with food items
     if not food_list:
         logger.info("No food items detected")
         return ""
 
-    if "recipe" in user_input:
+    if extracted["intent"] == "recipe":
         return ""
 
     # Define items that should be ignored as a food
     ignore_list = {"breakfast", "dinner", "snack", "meal", "fruit", "vegetable"}
-    lines = []
-    for food in food_list:
-        # Check if food item is in ignore list
-        if food in ignore_list:
-            continue
+    food_list = [food for food in food_list if food not in ignore_list]
+    # Look up each food once, even if it was extracted in different cases
+    seen = set()
+    food_list = [
+        food
+        for food in food_list
+        if not (food.upper() in seen or seen.add(food.upper()))
+    ]
+
+    # The message only depends on the foods, so messages naming the same
+    # foods share a cache entry. The food names are kept apart as a JSON list.
+    key = prompt_cache.key_for(
+        "nutrition",
+        json.dumps([food.upper() for food in food_list]),
+        "fineli",
+        NUTRITION_MESSAGE_VERSION,
+        normalize=False,
+    )
+    nutrition_message = await prompt_cache.get(key)
+    if nutrition_message is not None:
+        return nutrition_message
 
-        # Get nutrition data from Fineli API
-        nutrition_info = get_nutritional_values(food.upper())
+    nutrition_infos = await get_nutritional_values_many(
+        [food.upper() for food in food_list]
+    )
 
+    lines = []
+    for food, nutrition_info in zip(food_list, nutrition_infos):
         # Make sure that nutrition_info is dictionary. Give custom prompt if that is the case
         if not isinstance(nutrition_info, dict):
             continue
 
         # If food ID found, format the nutritional info and ask the model to analyze
+        heading = (
+            f"Here is the nutritional analysis per 100g from Fineli for {food.title()}"
+        )
+        if nutrition_info.get("Approximate match"):
+            heading += (
+                " (approximate, the closest Fineli food is "
+                f"{nutrition_info['Approximate match'].title()})"
+            )
         lines.extend(
             [
-                f"Here is the nutritional analysis per 100g from Fineli for {food.title()}:\n",
-                f"Calories: {nutrition_info['Calories']:.3f} kcal\n",
-                f"Protein: {nutrition_info['Protein']:.3f} g\n",
-                f"Fat: {nutrition_info['Fat']:.3f} g\n",
-                f"Carbohydrates: {nutrition_info['Carbohydrates']:.3f} g\n",
-                f"Fiber: {nutrition_info['Fiber']:.3f} g\n\n",
+                f"{heading}:\n",
+                f"Calories: {format_amount(nutrition_info['Calories'], 'kcal')}\n",
+                f"Protein: {format_amount(nutrition_info['Protein'], 'g')}\n",
+                f"Fat: {format_amount(nutrition_info['Fat'], 'g')}\n",
+                f"Carbohydrates: {format_amount(nutrition_info['Carbohydrates'], 'g')}\n",
+                f"Fiber: {format_amount(nutrition_info['Fiber'], 'g')}\n\n",
             ]
         )
 
     nutrition_message = "".join(lines)
+    # Only keep messages built from the local store, and not those missing
+    # foods because of a failed Fineli request
+    if fineli_store.is_available() and not any(
+        isinstance(info, str) and info.startswith("Error fetching")
+        for info in nutrition_infos
+    ):
+        await prompt_cache.set(key, nutrition_message)
 
     return nutrition_message
 
 
-def get_prompt(
+async def get_prompt(
     image_result_info,
     chat_history,
     healthConditions,
@@ -406,6 +539,7 @@ def get_prompt(
     dislikedDishes,
     user_input,
     nutrition_message,
+    extracted,
 ):
     # Handle a case where user loads image and image recognition result is available
     if image_result_info:
@@ -425,15 +559,22 @@ def get_prompt(
 
         return chat_history
 
-    if "recipe" in user_input.lower():
+    if extracted["intent"] == "recipe":
         logger.info("Recipe request detected, trying to find a recipe")
-        extracted_recipes = filter_recipes(user_input)
-        recipe_names = get_recipe_names(extracted_recipes)
+        extracted_recipes = ", ".join(extracted["recipes"])
+        recipe_names = get_recipe_names(extracted["recipes"])
+        if not recipe_names:
+            # Catch synonyms before falling back to the dish components
+            recipe_names = await semantic_index.similar_recipe_names(extracted_recipes)
         if not recipe_names:
-            extracted_individual_recipes = filter_individual_recipes(user_input)
-            recipe_names = get_individual_recipes_names(extracted_individual_recipes)
-        if recipe_names:
-            details = get_recipes_details(recipe_names)
+            recipe_names = get_recipe_names(extracted["components"])
+        # No details when MAX_PROMPT_RECIPES leaves no room for recipes
+        details = (
+            get_recipes_details(recipe_names, f"{extracted_recipes} {user_input}")
+            if recipe_names
+            else []
+        )
+        if details:
             prompt = f"""
             Here are the details of the recipes found for the input "{user_input}", where the user asks a recipe for "{extracted_recipes}":
 
@@ -474,7 +615,7 @@ def get_prompt(
             return chat_history
 
     # If nutrition_message contains nutritional data, give data for model to analyze
-    if nutrition_message and "recipe" not in user_input.lower():
+    if nutrition_message and extracted["intent"] != "recipe":
         logger.info("Nutritional values detected")
         prompt = f"""
         Analyze the following nutritional data in context of the user's query.
@@ -511,11 +652,22 @@ def get_prompt(
     return chat_history
 
 
-@app.route("/chat_history/<user_id>", methods=["POST"])
-def create_new_chat(user_id):
+@app.get("/stats")
+async def get_stats():
+    # Counters are kept per worker
+    return {
+        "pid": os.getpid(),
+        "extraction": extraction.extraction_stats(),
+        "prompt_cache": prompt_cache.stats(),
+        "context": context_builder.context_stats(),
+    }
+
+
+@app.post("/chat_history/{user_id}")
+async def create_new_chat(user_id: str, request: Request):
     try:
         # Get chat_id and chat_name from payload
-        data = request.get_json()
+        data = await request.json()
         chat_id = data.get("chatId")
         chat_name = data.get("chatName")
 
@@ -529,105 +681,264 @@ def create_new_chat(user_id):
         }
 
         # Insert new chat to MongoDB
-        chat_collection.insert_one(new_chat)
+        await chat_collection.insert_one(new_chat)
 
-        return jsonify({"message": "New chat created successfully"}), 201
+        return JSONResponse(
+            {"message": "New chat created successfully"}, status_code=201
+        )
+    except DuplicateKeyError:
+        return JSONResponse({"error": "Chat already exists"}, status_code=409)
     except Exception as e:
         logger.error("Error creating chat: %s", e)
-        return jsonify({"error": "Failed to create chat"}), 500
+        return JSONResponse({"error": "Failed to create chat"}, status_code=500)
 
 
-@app.route("/chat_history/<user_id>", methods=["GET"])
-def get_chat_list(user_id):
+@app.get("/chat_history/{user_id}")
+async def get_chat_list(user_id: str):
     try:
-        # Find all chat_ids and chat_names based on user_id
-        chats = list(chat_collection.find({"user_id": user_id}))
+        # Find all chat_ids and chat_names based on user_id, without the
+        # histories
+        chats = await chat_collection.find(
+            {"user_id": user_id}, {"_id": 0, "chat_id": 1, "chat_name": 1}
+        ).to_list()
         chat_list = []
         for chat in chats:
             chat_list.append(
                 {"id": chat.get("chat_id", ""), "name": chat.get("chat_name", "")}
             )
-        return jsonify(chat_list)
+        return JSONResponse(chat_list)
     except Exception as e:
         logger.error("Error in get_chat_list: %s", e)
-        return jsonify({"error": "Failed to load chat history"}), 500
+        return JSONResponse({"error": "Failed to load chat history"}, status_code=500)
+
+
+def image_mime_type(image_binary):
+    kind = filetype.guess(image_binary)
+    return kind.mime if kind else "image/jpeg"
+
+
+def entry_image_id(entry):
+    # Image id of a history entry, and the image bytes if the entry holds
+    # them. Entries not yet moved to the image store by
+    # 'python image_store.py migrate' still do, and their id is the hash.
+    if entry.get("image_id"):
+        return entry["image_id"], None
+    if entry.get("image") is not None:
+        image_binary = bytes(entry["image"])
+        return image_store.image_id_for(image_binary), image_binary
+    return None, None
+
+
+async def get_entry_image(entry):
+    # Image of a history entry and its id
+    image_id, image_binary = entry_image_id(entry)
+    if image_binary is None and image_id:
+        image_binary = await images.get(image_id)
+    return image_binary, image_id
+
+
+def history_page_pipeline(user_id, chat_id, before, limit, include_images):
+    # One page of history entries ending before the cursor, sliced and
+    # stripped of image bytes by MongoDB so only the page is sent back
+    entry = {
+        "user_message": "$$entry.user_message",
+        "bot_message": "$$entry.bot_message",
+        "image_result": "$$entry.image_result",
+        "nutrition_message": "$$entry.nutrition_message",
+        "has_image": {
+            "$ne": [
+                {
+                    "$ifNull": [
+                        "$$entry.image_id",
+                        {"$ifNull": ["$$entry.image", None]},
+                    ]
+                },
+                None,
+            ]
+        },
+    }
+    if include_images:
+        entry["image_id"] = "$$entry.image_id"
+        entry["image"] = "$$entry.image"
+
+    size = {"$size": "$history"}
+    return [
+        {"$match": {"user_id": user_id, "chat_id": chat_id}},
+        {"$project": {"_id": 0, "history": {"$ifNull": ["$history", []]}}},
+        {
+            "$set": {
+                "total": size,
+                "end": size if before is None else {"$min": [size, before]},
+            }
+        },
+        {"$set": {"start": {"$max": [0, {"$subtract": ["$end", limit]}]}}},
+        {
+            "$project": {
+                "total": 1,
+                "start": 1,
+                "history": {
+                    "$map": {
+                        "input": {
+                            "$slice": [
+                                "$history",
+                                "$start",
+                                {"$max": [1, {"$subtract": ["$end", "$start"]}]},
+                            ]
+                        },
+                        "as": "entry",
+                        "in": entry,
+                    }
+                },
+            }
+        },
+    ]
 
 
-@app.route("/chat_one", methods=["GET"])
-def get_chat_history():
+@app.get("/chat_one")
+async def get_chat_history(request: Request):
     try:
         # Get user_id and chat_id from parameters
-        user_id = request.args.get("userId")
-        chat_id = request.args.get("chatId")
+        user_id = request.query_params.get("userId")
+        chat_id = request.query_params.get("chatId")
+        # Pages go from the newest entries backwards. before is the
+        # next_cursor of the previous page, the index after the last entry
+        # to return. Images are left out unless asked for, and can be
+        # loaded one by one from /chat_image.
+        try:
+            limit = int(request.query_params.get("limit", CHAT_PAGE_SIZE))
+            before = request.query_params.get("before")
+            before = int(before) if before else None
+        except ValueError:
+            return JSONResponse(
+                {"error": "limit and before must be integers"}, status_code=400
+            )
+        if not 1 <= limit <= MAX_CHAT_PAGE_SIZE or (before is not None and before < 1):
+            return JSONResponse(
+                {"error": f"limit must be 1-{MAX_CHAT_PAGE_SIZE} and before positive"},
+                status_code=400,
+            )
+        include_images = request.query_params.get("images") == "true"
 
-        # Find the correct object from MongoDB to get chat history
-        chat_document = chat_collection.find_one(
-            {"user_id": user_id, "chat_id": chat_id}
+        cursor = await chat_collection.aggregate(
+            history_page_pipeline(user_id, chat_id, before, limit, include_images)
         )
-        # Make sure to return only the history array from database
-        if chat_document and "history" in chat_document:
-            history = []
-            for message in chat_document.get("history", []):
-                processed_message = {
-                    "user_message": message.get("user_message"),
-                    "bot_message": message.get("bot_message"),
-                    "image_result": message.get("image_result"),
-                    "nutrition_message": message.get("nutrition_message"),
-                    "image": None,
-                }
-
-                if "image" in message and message["image"] is not None:
-                    image_binary = message["image"]
+        chat_documents = await cursor.to_list()
+        if not chat_documents:
+            logger.info("No history found for chat_id: %s", chat_id)
+            return JSONResponse({"error": "No chat history found"}, status_code=404)
+
+        page = chat_documents[0]
+        history = page["history"]
+        if include_images:
+            entry_images = await asyncio.gather(
+                *(get_entry_image(message) for message in history)
+            )
+        for index, message in enumerate(history, start=page["start"]):
+            message["index"] = index
+            if include_images:
+                image_binary = entry_images[index - page["start"]][0]
+                message.pop("image_id", None)
+                message["image"] = None
+                if image_binary is not None:
                     encoded_image = base64.b64encode(image_binary).decode("utf-8")
-                    kind = filetype.guess(image_binary)
-                    if not kind:
-                        kind = "image/jpeg"
+                    mime_type = image_mime_type(image_binary)
+                    message["image"] = f"data:{mime_type};base64,{encoded_image}"
+
+        logger.info("Returning %s history items for chat_id: %s", len(history), chat_id)
+        return JSONResponse(
+            {
+                "history": history,
+                "total": page["total"],
+                "next_cursor": page["start"] or None,
+            }
+        )
 
-                    processed_message["image"] = f"data:{kind};base64,{encoded_image}"
+    except Exception as e:
+        logger.error("Error loading chat history: %s", e)
+        return JSONResponse({"error": "Failed to load chat history"}, status_code=500)
 
-                history.append(processed_message)
 
-            logger.info(
-                f"Returning {len(history)} history items for chat_id: {chat_id}"
+@app.get("/chat_image")
+async def get_chat_image(request: Request):
+    try:
+        user_id = request.query_params.get("userId")
+        chat_id = request.query_params.get("chatId")
+        try:
+            index = int(request.query_params.get("index", ""))
+        except ValueError:
+            index = -1
+        if index < 0:
+            return JSONResponse(
+                {"error": "index must be a history index"}, status_code=400
             )
-            return jsonify(history)
 
-        logger.info(f"No history found for chat_id: {chat_id}")
-        return jsonify({"error": "No chat history found"}), 404
+        # Only the one history entry is read from the chat
+        chat_document = await chat_collection.find_one(
+            {"user_id": user_id, "chat_id": chat_id},
+            {"_id": 0, "history": {"$slice": [index, 1]}},
+        )
+        entries = (chat_document or {}).get("history") or [{}]
+        image_id, image_binary = entry_image_id(entries[0])
+        if image_id is None:
+            return JSONResponse({"error": "Image not found"}, status_code=404)
+
+        # Images are named by their hash, so the image at an index can be
+        # cached for as long as the chat exists, and a cached copy is
+        # confirmed without reading the image
+        etag = f'"{image_id}"'
+        headers = {
+            "Cache-Control": f"private, max-age={IMAGE_CACHE_MAX_AGE}, immutable",
+            "ETag": etag,
+        }
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        if image_binary is None:
+            image_binary = await images.get(image_id)
+        if image_binary is None:
+            return JSONResponse({"error": "Image not found"}, status_code=404)
+        return Response(
+            image_binary,
+            media_type=image_mime_type(image_binary),
+            headers=headers,
+        )
 
     except Exception as e:
-        logger.error("Error loading chat history: %s", e)
-        return jsonify({"error": "Failed to load chat history"}), 500
+        logger.error("Error loading chat image: %s", e)
+        return JSONResponse({"error": "Failed to load chat image"}, status_code=500)
 
 
-@app.route("/chat_history/<user_id>", methods=["DELETE"])
-def delete_chat_history(user_id):
+@app.delete("/chat_history/{user_id}")
+async def delete_chat_history(user_id: str, request: Request):
     try:
         # Get chat_id from payload
-        data = request.get_json()
+        data = await request.json()
         chat_id = data.get("chatId", None)
 
         if not chat_id:
-            return jsonify({"error": "chatId is required to delete chat history"}), 401
+            return JSONResponse(
+                {"error": "chatId is required to delete chat history"}, status_code=401
+            )
 
         # Find the right chat_history object to delete from mongo
-        deleted_chat = db.chat_history.delete_one(
+        deleted_chat = await db.chat_history.delete_one(
             {"user_id": user_id, "chat_id": chat_id}
         )
         logger.info("DELETED CHAT COUNT: %s", deleted_chat.deleted_count)
 
         # Check if correct chat was found and deleted
         if deleted_chat.deleted_count == 0:
-            return jsonify({"error": "Chat not found"}), 400
-        return jsonify({"message": "Chat deleted successfully"}), 200
+            return JSONResponse({"error": "Chat not found"}, status_code=400)
+        return JSONResponse({"message": "Chat deleted successfully"}, status_code=200)
 
     except Exception as e:
         logger.error("Error deleting chat history: %s", e)
-        return jsonify({"error": "Failed to delete chat history"}), 500
+        return JSONResponse({"error": "Failed to delete chat history"}, status_code=500)
 
 
 if __name__ == "__main__":
+    import uvicorn
+
     if PRODUCTION:
-        app.run(host="0.0.0.0", port=5000, debug=False)
+        uvicorn.run("llamaModel:app", host="0.0.0.0", port=5000)
     else:
-        app.run(debug=True)
+        uvicorn.run("llamaModel:app", port=5000, reload=True)
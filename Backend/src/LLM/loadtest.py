@@ -0,0 +1,118 @@
+"""
+Load test for the chat service.
+
+Measures the latency of a single /chat request, then sends concurrent
+requests and reports throughput and latency under load. Throughput times the
+unloaded latency is how many requests the service actually worked on at once,
+which is reported overall and per worker. A sync worker can only ever work on
+one request at a time.
+
+Usage: python loadtest.py [--url http://localhost:5000] [--concurrency 32]
+                          [--requests 128] [--workers 4]
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+import httpx
+
+
+async def send_chat(client, url, message, user_id, chat_id):
+    start = time.perf_counter()
+    response = await client.post(
+        f"{url}/chat",
+        data={"message": message, "userId": user_id, "chatId": chat_id},
+    )
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def run(args):
+    user_id = args.user_id or uuid.uuid4().hex
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        # One chat per concurrent client, like separate users
+        chat_ids = [uuid.uuid4().hex for _ in range(args.concurrency)]
+        for chat_id in chat_ids:
+            response = await client.post(
+                f"{args.url}/chat_history/{user_id}",
+                json={"chatId": chat_id, "chatName": "Load test"},
+            )
+            response.raise_for_status()
+
+        # Unloaded latency, after one warm-up request
+        await send_chat(client, args.url, args.message, user_id, chat_ids[0])
+        baseline = statistics.median(
+            [
+                await send_chat(client, args.url, args.message, user_id, chat_ids[0])
+                for _ in range(3)
+            ]
+        )
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies = []
+        failures = 0
+
+        async def worker(number):
+            nonlocal failures
+            async with semaphore:
+                try:
+                    latencies.append(
+                        await send_chat(
+                            client,
+                            args.url,
+                            args.message,
+                            user_id,
+                            chat_ids[number % len(chat_ids)],
+                        )
+                    )
+                except httpx.HTTPError as e:
+                    failures += 1
+                    print(f"Request {number} failed: {e!r}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(number) for number in range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+        for chat_id in chat_ids:
+            await client.request(
+                "DELETE", f"{args.url}/chat_history/{user_id}", json={"chatId": chat_id}
+            )
+
+    if not latencies:
+        raise SystemExit("Every request failed")
+    latencies.sort()
+    throughput = len(latencies) / elapsed
+    in_flight = throughput * baseline
+    print(
+        f"{len(latencies)} requests, {failures} failed, concurrency {args.concurrency}"
+    )
+    print(f"unloaded latency: {baseline * 1000:.0f} ms")
+    print(f"throughput: {throughput:.2f} requests/s")
+    print(
+        f"latency under load: p50 {statistics.median(latencies) * 1000:.0f} ms, "
+        f"p95 {latencies[max(0, int(len(latencies) * 0.95) - 1)] * 1000:.0f} ms"
+    )
+    print(
+        f"in flight: {in_flight:.1f} in total, "
+        f"{in_flight / args.workers:.1f} per worker ({args.workers} workers)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=128)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--message", default="I ate 2 eggs and a banana")
+    parser.add_argument("--user-id")
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
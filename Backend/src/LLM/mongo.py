@@ -0,0 +1,78 @@
+"""
+MongoDB connection settings and the indexes the chat service relies on.
+
+Clients are created per worker, after gunicorn has forked, since a client
+and its connection pool cannot be shared between processes. The pool size
+is per worker, so the service opens up to workers * MONGO_MAX_POOL_SIZE
+connections.
+"""
+
+import logging
+import os
+import dotenv
+from pymongo import ASCENDING, AsyncMongoClient
+from pymongo.errors import ConnectionFailure, PyMongoError
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MONGODB_URI = os.environ.get("MONGODB_URI")
+DATABASE = "NutriVision"
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+# Connections kept open while idle, so a burst does not start by connecting
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "2"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+# How long to wait for a reachable server and for a new connection
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")
+)
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+# Longest a single operation may take, including retries
+MONGO_TIMEOUT_MS = int(os.getenv("MONGO_TIMEOUT_MS", "10000"))
+MONGO_CREATE_INDEXES = os.getenv("MONGO_CREATE_INDEXES", "true") == "true"
+
+# Indexes of chat_history, as (keys, options). The compound index also
+# serves the queries by user_id alone. Queries by chat_id alone come from
+# the chat endpoints, which do not get the user id.
+CHAT_INDEXES = [
+    (
+        [("user_id", ASCENDING), ("chat_id", ASCENDING)],
+        {"name": "user_id_chat_id", "unique": True},
+    ),
+    ([("chat_id", ASCENDING)], {"name": "chat_id"}),
+]
+
+
+def client_options(timeout_ms=MONGO_TIMEOUT_MS):
+    return {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "timeoutMS": timeout_ms,
+        "appname": "nutrivision-llm",
+    }
+
+
+def create_client(uri=MONGODB_URI, timeout_ms=MONGO_TIMEOUT_MS):
+    # Maintenance tools that walk whole collections pass timeout_ms=None,
+    # since the timeout also covers iterating a cursor
+    return AsyncMongoClient(uri, **client_options(timeout_ms))
+
+
+async def ensure_indexes(chat_collection):
+    # Every worker runs this at startup. Creating an index that already
+    # exists does nothing, so only the first worker of a new deployment
+    # builds them. A failure is logged rather than stopping the service.
+    if not MONGO_CREATE_INDEXES:
+        return
+    for keys, options in CHAT_INDEXES:
+        try:
+            await chat_collection.create_index(keys, **options)
+        except ConnectionFailure as e:
+            logger.error("Could not create indexes, MongoDB is not reachable: %s", e)
+            return
+        except PyMongoError as e:
+            logger.error("Could not create index %s: %s", options["name"], e)
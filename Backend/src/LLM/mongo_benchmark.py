@@ -0,0 +1,164 @@
+"""
+Benchmark for the chat_history queries of the chat service.
+
+Fills a scratch database with chats, then times each query the service
+runs and prints the plan MongoDB picks for it, first without and then with
+the indexes from mongo.py. Without --uri it runs against mongomock, which
+gives latencies but no query plans.
+
+Usage: python mongo_benchmark.py [--uri mongodb://localhost:27017]
+                                 [--users 200] [--chats 10] [--messages 20]
+                                 [--repeat 200]
+"""
+
+import argparse
+import random
+import statistics
+import time
+import uuid
+from pymongo import MongoClient
+import mongo
+
+BENCHMARK_DATABASE = "NutriVision_benchmark"
+
+
+def seed(collection, users, chats, messages):
+    documents = []
+    for _ in range(users):
+        user_id = uuid.uuid4().hex
+        for number in range(chats):
+            documents.append(
+                {
+                    "user_id": user_id,
+                    "chat_id": uuid.uuid4().hex,
+                    "chat_name": f"Chat {number}",
+                    "history": [
+                        {
+                            "user_message": "I ate 2 eggs and a banana",
+                            "bot_message": "Eggs are a good source of protein. " * 20,
+                            "image_id": None,
+                            "image_result": "",
+                            "nutrition_message": "",
+                        }
+                        for _ in range(messages)
+                    ],
+                }
+            )
+    collection.insert_many(documents)
+    return [(document["user_id"], document["chat_id"]) for document in documents]
+
+
+def queries(collection, user_id, chat_id):
+    # The queries of the service, as (name, query, find command to explain)
+    return [
+        (
+            "chat list by user_id",
+            lambda: list(
+                collection.find(
+                    {"user_id": user_id}, {"_id": 0, "chat_id": 1, "chat_name": 1}
+                )
+            ),
+            {"find": collection.name, "filter": {"user_id": user_id}},
+        ),
+        (
+            "last messages by chat_id",
+            lambda: collection.find_one(
+                {"chat_id": chat_id}, {"history": {"$slice": -10}}
+            ),
+            {"find": collection.name, "filter": {"chat_id": chat_id}, "limit": 1},
+        ),
+        (
+            "chat by user_id and chat_id",
+            lambda: collection.find_one(
+                {"user_id": user_id, "chat_id": chat_id},
+                {"_id": 0, "history": {"$slice": [0, 1]}},
+            ),
+            {
+                "find": collection.name,
+                "filter": {"user_id": user_id, "chat_id": chat_id},
+                "limit": 1,
+            },
+        ),
+    ]
+
+
+def plan_stages(plan):
+    # Stages of the winning plan from the top down, like FETCH <- IXSCAN
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage = f"{stage} {plan['indexName']}"
+        stages.append(stage)
+        plan = plan.get("inputStage")
+    return " <- ".join(stages)
+
+
+def explain(db, command):
+    try:
+        result = db.command("explain", command, verbosity="executionStats")
+    except (NotImplementedError, TypeError):
+        # mongomock has no explain
+        return "n/a"
+    planner = result["queryPlanner"]
+    plan = planner["winningPlan"]
+    # Plans of the slot based engine nest the classic plan one level down
+    plan = plan.get("queryPlan", plan)
+    stats = result["executionStats"]
+    return (
+        f"{plan_stages(plan)}, examined {stats['totalDocsExamined']} documents "
+        f"and {stats['totalKeysExamined']} keys"
+    )
+
+
+def run(db, collection, chats, repeat):
+    latencies = {}
+    for _ in range(repeat):
+        for name, query, _ in queries(collection, *random.choice(chats)):
+            start = time.perf_counter()
+            query()
+            latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+    for name, _, command in queries(collection, *chats[0]):
+        times = sorted(latencies[name])
+        print(
+            f"  {name}: p50 {statistics.median(times) * 1000:.2f} ms, "
+            f"p95 {times[max(0, int(len(times) * 0.95) - 1)] * 1000:.2f} ms"
+        )
+        print(f"    plan: {explain(db, command)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uri", help="MongoDB to use, mongomock if not given")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=10, help="Chats per user")
+    parser.add_argument("--messages", type=int, default=20, help="Messages per chat")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.uri:
+        client = MongoClient(args.uri)
+    else:
+        import mongomock
+
+        client = mongomock.MongoClient()
+    db = client[BENCHMARK_DATABASE]
+    collection = db["chat_history"]
+    collection.drop()
+    try:
+        chats = seed(collection, args.users, args.chats, args.messages)
+        print(f"{len(chats)} chats with {args.messages} messages each")
+        print("Without indexes:")
+        run(db, collection, chats, args.repeat)
+        for keys, options in mongo.CHAT_INDEXES:
+            collection.create_index(keys, **options)
+        print("With indexes:")
+        run(db, collection, chats, args.repeat)
+    finally:
+        client.drop_database(BENCHMARK_DATABASE)
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
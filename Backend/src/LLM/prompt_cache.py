@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import dotenv
+
+dotenv.load_dotenv()
+
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "1024"))
+PROMPT_CACHE_TTL = float(os.getenv("PROMPT_CACHE_TTL", "86400"))  # seconds
+# Optional SQLite file shared by all workers, empty to disable
+PROMPT_CACHE_DB = os.getenv("PROMPT_CACHE_DB", "")
+
+
+def normalize_text(text):
+    # Messages that differ only in case, spacing or closing punctuation share
+    # an entry
+    return " ".join(text.lower().split()).rstrip("?!. ")
+
+
+class PromptCache:
+    """
+    What the chat derives from a message with a model call or lookups, such
+    as extractions and nutrition messages, so a repeated question skips that
+    work. Keys are built by key_for and start with the kind of result, which
+    the hit and miss counts of /stats are grouped by.
+
+    Each worker keeps the most recently used results in memory. With
+    PROMPT_CACHE_DB set, results are also written to a SQLite file, so a
+    worker can reuse what the other workers on the host computed. SQLite
+    may wait up to 5 seconds for a lock, so the file is only used from one
+    thread per worker, which keeps its connection open.
+    """
+
+    def __init__(
+        self, max_size=PROMPT_CACHE_SIZE, ttl=PROMPT_CACHE_TTL, db_path=PROMPT_CACHE_DB
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (expires, result), least recently used first. Only the event
+        # loop touches it, so it needs no lock.
+        self.recent = OrderedDict()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.db_thread = None
+        self.connection = None
+        if db_path:
+            self.db_thread = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="prompt-cache"
+            )
+            self.connection = self.db_thread.submit(self._open, db_path).result()
+
+    @staticmethod
+    def _open(db_path):
+        connection = sqlite3.connect(db_path, timeout=5, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS prompt_cache "
+            "(key TEXT PRIMARY KEY, result TEXT, expires REAL)"
+        )
+        return connection
+
+    @staticmethod
+    def key_for(kind, text, model, version, normalize=True):
+        # Keys of text that is not a user message, such as a list of foods,
+        # pass normalize=False, since normalizing could make them collide
+        if normalize:
+            text = normalize_text(text)
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+        return f"{kind}:{model}:{version}:{digest}"
+
+    async def get(self, key):
+        now = time.time()
+        entry = self.recent.get(key)
+        if entry is not None and entry[0] < now:
+            del self.recent[key]
+            entry = None
+        if entry is None and self.connection is not None:
+            entry = await self._in_db_thread(self._read, key, now)
+        kind = key.split(":", 1)[0]
+        if entry is None:
+            self.misses[kind] += 1
+            return None
+        self.hits[kind] += 1
+        # An entry read from the file keeps the expiry it was written with
+        self._remember(key, entry)
+        return entry[1]
+
+    async def set(self, key, result):
+        entry = (time.time() + self.ttl, result)
+        self._remember(key, entry)
+        if self.connection is not None:
+            await self._in_db_thread(self._write, key, entry)
+
+    def stats(self):
+        return {
+            kind: {
+                "hits": self.hits[kind],
+                "misses": self.misses[kind],
+                "hit_rate": self.hits[kind] / (self.hits[kind] + self.misses[kind]),
+            }
+            for kind in sorted(set(self.hits) | set(self.misses))
+        }
+
+    def _remember(self, key, entry):
+        self.recent[key] = entry
+        self.recent.move_to_end(key)
+        if len(self.recent) > self.max_size:
+            self.recent.popitem(last=False)
+
+    async def _in_db_thread(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_thread, function, *args)
+
+    def _read(self, key, now):
+        row = self.connection.execute(
+            "SELECT expires, result FROM prompt_cache WHERE key = ? AND expires >= ?",
+            (key, now),
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def _write(self, key, entry):
+        expires, result = entry
+        # Writes are much rarer than reads, so expired rows are dropped here
+        self.connection.execute(
+            "DELETE FROM prompt_cache WHERE expires < ?", (time.time(),)
+        )
+        self.connection.execute(
+            "INSERT OR REPLACE INTO prompt_cache VALUES (?, ?, ?)",
+            (key, json.dumps(result), expires),
+        )
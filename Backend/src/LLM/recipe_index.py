@@ -0,0 +1,203 @@
+import csv
+import math
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+import dotenv
+
+dotenv.load_dotenv()
+
+# Most recipes put into one prompt, 0 for none
+MAX_PROMPT_RECIPES = int(os.getenv("MAX_PROMPT_RECIPES", "5"))
+
+# BM25 parameters and how much a term counts in each field
+BM25_K1 = 1.2
+BM25_B = 0.75
+FIELD_WEIGHTS = {"name": 3.0, "summary": 1.0, "ingredient": 1.0}
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "a", "an", "and", "for", "from", "i", "in", "is", "it", "me", "my", "of",
+    "on", "or", "please", "recipe", "recipes", "some", "the", "to", "with",
+}  # fmt: skip
+
+
+def trigrams(text):
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        # Fold simple plurals so that "eggs" matches "egg"
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class RecipeIndex:
+    """
+    In-memory index over allrecipes.csv, loaded once per worker.
+
+    Recipe ids are row numbers, so returning ids in ascending order keeps
+    the file order the old csv scans produced. Name searches are
+    case-insensitive substring matches, narrowed down with a trigram index
+    over the lowercased names before the final check.
+    """
+
+    def __init__(self, recipes):
+        self.recipes = recipes
+        self.lower_names = [recipe["name"].lower() for recipe in recipes]
+
+        self.ids_by_name = {}
+        self.ids_by_trigram = {}
+        for recipe_id, recipe in enumerate(recipes):
+            self.ids_by_name.setdefault(recipe["name"], []).append(recipe_id)
+            name = self.lower_names[recipe_id]
+            for trigram in trigrams(name):
+                self.ids_by_trigram.setdefault(trigram, []).append(recipe_id)
+        self._build_bm25()
+
+    def _build_bm25(self):
+        # Field-weighted term frequencies per recipe, stored as postings
+        # lists of (recipe id, weighted tf) for each term
+        self.postings = {}
+        lengths = []
+        for recipe_id, recipe in enumerate(self.recipes):
+            frequencies = Counter()
+            for field, weight in FIELD_WEIGHTS.items():
+                for token in tokenize(recipe.get(field) or ""):
+                    frequencies[token] += weight
+            for term, frequency in frequencies.items():
+                self.postings.setdefault(term, []).append((recipe_id, frequency))
+            lengths.append(sum(frequencies.values()))
+
+        count = len(self.recipes)
+        average = sum(lengths) / count if count else 0.0
+        self.idf = {
+            term: math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+        # Length normalisation is fixed per recipe, so compute it up front
+        self.norms = [
+            BM25_K1 * (1 - BM25_B + BM25_B * length / average) if average else BM25_K1
+            for length in lengths
+        ]
+
+    @classmethod
+    def from_csv(cls, csv_file):
+        with open(csv_file, "r", encoding="ISO-8859-1") as file:
+            recipes = list(csv.DictReader(file))
+        return cls(recipes)
+
+    def search_ids(self, text):
+        # Ids of every recipe whose name contains text, in file order
+        query = text.lower()
+        if len(query) < 3:
+            candidates = range(len(self.recipes))
+        else:
+            # Only names containing every trigram of the query can match
+            candidates = None
+            for trigram in trigrams(query):
+                ids = self.ids_by_trigram.get(trigram)
+                if ids is None:
+                    return []
+                if candidates is None:
+                    candidates = set(ids)
+                else:
+                    candidates.intersection_update(ids)
+            candidates = sorted(candidates)
+        return [
+            recipe_id
+            for recipe_id in candidates
+            if query in self.lower_names[recipe_id]
+        ]
+
+    def search_names(self, text):
+        return [self.recipes[recipe_id]["name"] for recipe_id in self.search_ids(text)]
+
+    def scores(self, query, candidates=None):
+        # BM25 score of every recipe sharing a term with the query, limited
+        # to candidates when given
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for recipe_id, frequency in self.postings[term]:
+                if candidates is not None and recipe_id not in candidates:
+                    continue
+                score = (
+                    idf
+                    * frequency
+                    * (BM25_K1 + 1)
+                    / (frequency + self.norms[recipe_id])
+                )
+                scores[recipe_id] = scores.get(recipe_id, 0.0) + score
+        return scores
+
+    def search(self, query, k=MAX_PROMPT_RECIPES, candidates=None):
+        # Top-k recipe ids for the query, ties broken by file order. Recipes
+        # listed under several groups are only returned once. Without
+        # matching terms the first candidates are returned unranked.
+        if k <= 0:
+            return []
+        scores = self.scores(query, candidates)
+        ranked = sorted(scores, key=lambda recipe_id: (-scores[recipe_id], recipe_id))
+        if candidates is not None:
+            ranked += [
+                recipe_id for recipe_id in sorted(candidates) if recipe_id not in scores
+            ]
+
+        results = []
+        seen = set()
+        for recipe_id in ranked:
+            name = self.recipes[recipe_id]["name"]
+            if name in seen:
+                continue
+            seen.add(name)
+            results.append(recipe_id)
+            if len(results) == k:
+                break
+        return results
+
+    def recipe_details(self, recipe_id):
+        recipe = self.recipes[recipe_id]
+        return {
+            "name": recipe["name"],
+            "ingredients": recipe["ingredient"],
+            "process": recipe["process"],
+        }
+
+    def details(self, names, query=None, k=None):
+        # Every recipe with one of the given names, in file order. With a
+        # query they are ranked by BM25 instead. With k only the first k are
+        # kept, so k <= 0 gives no recipes.
+        if k is not None and k <= 0:
+            return []
+        recipe_ids = sorted(
+            recipe_id
+            for name in set(names)
+            for recipe_id in self.ids_by_name.get(name, ())
+        )
+        if query is not None:
+            recipe_ids = self.search(query, k or len(recipe_ids), set(recipe_ids))
+        elif k is not None:
+            recipe_ids = recipe_ids[:k]
+        return [self.recipe_details(recipe_id) for recipe_id in recipe_ids]
+
+
+@lru_cache(maxsize=None)
+def get_recipe_index(csv_file="allrecipes.csv"):
+    return RecipeIndex.from_csv(csv_file)
+
+
+def search_recipes(query, k=MAX_PROMPT_RECIPES):
+    # Top-k recipes for the query, ranked by BM25 over the recipe name,
+    # summary and ingredients
+    index = get_recipe_index()
+    return [index.recipe_details(recipe_id) for recipe_id in index.search(query, k)]
@@ -0,0 +1,218 @@
+"""
+Semantic search over the recipe names and Fineli food names.
+
+Names are embedded offline with a local embedding model served by Ollama and
+stored as a normalised float32 matrix that every gunicorn worker memory-maps.
+At query time only the query text is embedded, and the nearest names are
+found with one matrix product and a NumPy top-k. Build the indexes with:
+
+    python semantic_index.py build recipes foods
+
+Without an index, or when the embedding model is not available, lookups
+return no matches and the chat falls back to its substring search.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+from functools import lru_cache
+import dotenv
+import numpy as np
+import ollama
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
+SEMANTIC_INDEX_DIR = os.getenv(
+    "SEMANTIC_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "semantic"),
+)
+# Cosine similarity a name needs to count as a match, and how many to return
+SEMANTIC_MIN_SCORE = float(os.getenv("SEMANTIC_MIN_SCORE", "0.75"))
+SEMANTIC_TOP_K = int(os.getenv("SEMANTIC_TOP_K", "5"))
+# Whether food names without a literal match fall back to the closest Fineli
+# food, and the stricter similarity such a match needs
+SEMANTIC_FOOD_MATCHES = os.getenv("SEMANTIC_FOOD_MATCHES", "false") == "true"
+SEMANTIC_FOOD_MIN_SCORE = float(os.getenv("SEMANTIC_FOOD_MIN_SCORE", "0.9"))
+EMBED_BATCH_SIZE = 256
+
+client = ollama.AsyncClient()
+
+
+def normalize_rows(vectors):
+    # Unit length float32 vectors, so a dot product is the cosine similarity
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def embed(texts):
+    # Used when building an index
+    vectors = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch = [text.lower() for text in texts[start : start + EMBED_BATCH_SIZE]]
+        response = ollama.embed(model=EMBED_MODEL, input=batch)
+        vectors.extend(response["embeddings"])
+    return normalize_rows(vectors)
+
+
+async def embed_queries(texts):
+    # Used at query time, without blocking the event loop
+    response = await client.embed(
+        model=EMBED_MODEL, input=[text.lower() for text in texts]
+    )
+    return normalize_rows(response["embeddings"])
+
+
+class VectorIndex:
+    """
+    Embedded names with an optional id per name.
+
+    Stored as <name>.npy (the vector matrix, memory-mapped on load) next to
+    <name>.json (the names, ids and the model that embedded them).
+    """
+
+    def __init__(self, labels, vectors, ids=None):
+        self.labels = labels
+        self.vectors = vectors
+        self.ids = ids
+
+    @classmethod
+    def load(cls, path):
+        with open(f"{path}.json", "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        if meta["model"] != EMBED_MODEL:
+            raise ValueError(
+                f"{path} was built with {meta['model']}, not {EMBED_MODEL}"
+            )
+        vectors = np.load(f"{path}.npy", mmap_mode="r")
+        if len(vectors) != len(meta["labels"]):
+            raise ValueError(f"Vector count does not match names in {path}")
+        return cls(meta["labels"], vectors, meta.get("ids"))
+
+    @classmethod
+    def build(cls, path, labels, ids=None):
+        vectors = embed(labels)
+        # Running workers keep the old matrix mapped, and rewriting it in
+        # place would change the vectors under them. The index is written to
+        # .tmp files that are renamed over the old ones. A worker loading it
+        # between the two renames gets a count mismatch from load() and does
+        # without the index.
+        matrix = np.lib.format.open_memmap(
+            f"{path}.tmp.npy", mode="w+", dtype=np.float32, shape=vectors.shape
+        )
+        matrix[:] = vectors
+        matrix.flush()
+        del matrix
+        with open(f"{path}.tmp.json", "w", encoding="utf-8") as file:
+            json.dump({"model": EMBED_MODEL, "labels": labels, "ids": ids}, file)
+        os.replace(f"{path}.tmp.npy", f"{path}.npy")
+        os.replace(f"{path}.tmp.json", f"{path}.json")
+        return cls.load(path)
+
+    def search(self, query_vectors, k=SEMANTIC_TOP_K, min_score=SEMANTIC_MIN_SCORE):
+        # For each query, the positions of the k most similar names scoring
+        # at least min_score, best first
+        scores = np.asarray(query_vectors, dtype=np.float32) @ self.vectors.T
+        k = min(k, scores.shape[1])
+        if k == 0:
+            return [[] for _ in scores]
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, positions in zip(scores, top):
+            positions = sorted(positions, key=lambda position: -row[position])
+            results.append(
+                [int(position) for position in positions if row[position] >= min_score]
+            )
+        return results
+
+
+@lru_cache(maxsize=None)
+def get_index(name, index_dir=SEMANTIC_INDEX_DIR):
+    path = os.path.join(index_dir, name)
+    if not os.path.exists(f"{path}.npy"):
+        logger.warning(
+            "Semantic index %s not found, run 'python semantic_index.py build %s'",
+            path,
+            name,
+        )
+        return None
+    try:
+        return VectorIndex.load(path)
+    except (ValueError, KeyError, OSError) as e:
+        logger.warning("Semantic index %s not loaded: %s", path, e)
+        return None
+
+
+async def search(name, queries, k=SEMANTIC_TOP_K, min_score=SEMANTIC_MIN_SCORE):
+    # Matching positions for each query, or no matches when the index or the
+    # embedding model is not available
+    index = get_index(name)
+    if index is None or not queries:
+        return [[] for _ in queries]
+    try:
+        query_vectors = await embed_queries(queries)
+    except Exception as e:
+        logger.warning("Embedding failed for semantic search: %s", e)
+        return [[] for _ in queries]
+    return index.search(query_vectors, k, min_score)
+
+
+async def similar_recipe_names(text, k=SEMANTIC_TOP_K):
+    text = text.strip()
+    if not text:
+        return []
+    index = get_index("recipes")
+    positions = (await search("recipes", [text], k))[0]
+    return [index.labels[position] for position in positions]
+
+
+async def similar_foods(food_names, min_score=SEMANTIC_FOOD_MIN_SCORE):
+    # Id and name of the closest Fineli food for each name, or None without
+    # a match
+    index = get_index("foods")
+    return [
+        (index.ids[positions[0]], index.labels[positions[0]]) if positions else None
+        for positions in await search("foods", food_names, 1, min_score)
+    ]
+
+
+def read_recipe_names(csv_file="allrecipes.csv"):
+    with open(csv_file, "r", encoding="ISO-8859-1") as file:
+        return list(dict.fromkeys(row["name"] for row in csv.DictReader(file)))
+
+
+def read_food_names(csv_file="foodname_EN.csv"):
+    with open(csv_file, mode="r", encoding="ISO-8859-1") as file:
+        rows = [
+            (int(row["FOODID"]), row["FOODNAME"])
+            for row in csv.DictReader(file, delimiter=";")
+        ]
+    return [name for _, name in rows], [food_id for food_id, _ in rows]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the semantic indexes")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Embed names and write an index")
+    build.add_argument(
+        "indexes", nargs="+", choices=["recipes", "foods"], help="Indexes to build"
+    )
+    build.add_argument(
+        "--dir", default=SEMANTIC_INDEX_DIR, help="Directory to write the indexes to"
+    )
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    for name in args.indexes:
+        if name == "recipes":
+            labels, ids = read_recipe_names(), None
+        else:
+            labels, ids = read_food_names()
+        VectorIndex.build(os.path.join(args.dir, name), labels, ids)
+        print(f"Embedded {len(labels)} {name} with {EMBED_MODEL} into {args.dir}")
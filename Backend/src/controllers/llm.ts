@@ -3,6 +3,7 @@ import axios from "axios";
 import FormData from "form-data";
 import { LLM_API_URL } from "../utils/config";
 import multer from "multer";
+import { Readable } from "stream";
 import logger from "../utils/logger";
 
 const llmRouter = Router();
@@ -13,14 +14,47 @@ interface CustomRequest extends Request {
   user?: any;
 }
 
+// Build the form sent to the LLM chat endpoints
+const chatFormData = (req: CustomRequest) => {
+  const { message, result, chatId } = req.body;
+  const user = req.user;
+  const image = req.file;
+
+  const formData = new FormData();
+  formData.append("message", message);
+  formData.append("chatId", chatId);
+  if (result) formData.append("imageRecognitionResult", result);
+  if (image) formData.append("image", image.buffer, image.originalname);
+  formData.append("healthConditions", JSON.stringify(user.healthConditions));
+  formData.append("diet", JSON.stringify(user.diet));
+  formData.append("allergies", JSON.stringify(user.allergies));
+  formData.append("favouriteDishes", JSON.stringify(user.favoriteDishes));
+  formData.append("dislikedDishes", JSON.stringify(user.dislikedDishes));
+  formData.append("userId", user._id.toString());
+  return formData;
+};
+
+// Pipe a streamed LLM response to the client. The client response is ended
+// if the LLM stream fails, and the LLM request is cancelled if the client
+// goes away.
+const pipeUpstream = (upstream: Readable, res: Response) => {
+  upstream.on("error", (err: Error) => {
+    logger.err("LLM stream failed:", err.message);
+    res.end();
+  });
+  // The response closes when it is done or the client disconnects. The
+  // request's own close event already fires once multer has read the body.
+  res.on("close", () => upstream.destroy());
+  upstream.pipe(res);
+};
+
 // Post a message to the LLM
 llmRouter.post(
   "/chat",
   upload.single("image"),
   async (req: CustomRequest, res: Response, next: NextFunction) => {
-    const { message, result, chatId } = req.body;
+    const { message, chatId } = req.body;
     const user = req.user;
-    const image = req.file;
     if (!user) {
       res.status(401).json({ error: "Unauthorized" });
       return;
@@ -28,17 +62,7 @@ llmRouter.post(
 
     logger.info("Sending message to LLM:", message, chatId);
 
-    const formData = new FormData();
-    formData.append("message", message);
-    formData.append("chatId", chatId);
-    if (result) formData.append("imageRecognitionResult", result);
-    if (image) formData.append("image", image.buffer, image.originalname);
-    formData.append("healthConditions", JSON.stringify(user.healthConditions));
-    formData.append("diet", JSON.stringify(user.diet));
-    formData.append("allergies", JSON.stringify(user.allergies));
-    formData.append("favouriteDishes", JSON.stringify(user.favoriteDishes));
-    formData.append("dislikedDishes", JSON.stringify(user.dislikedDishes));
-    formData.append("userId", user._id.toString());
+    const formData = chatFormData(req);
 
     logger.info("LLM Message:", formData);
 
@@ -61,6 +85,42 @@ llmRouter.post(
   }
 );
 
+// Post a message to the LLM and stream the reply back as newline-delimited
+// JSON events
+llmRouter.post(
+  "/chat/stream",
+  upload.single("image"),
+  async (req: CustomRequest, res: Response, next: NextFunction) => {
+    const { message, chatId } = req.body;
+    const user = req.user;
+    if (!user) {
+      res.status(401).json({ error: "Unauthorized" });
+      return;
+    }
+
+    logger.info("Streaming message to LLM:", message, chatId);
+
+    const formData = chatFormData(req);
+
+    try {
+      const llmResponse = await axios.post(baseUrl + "/chat/stream", formData, {
+        headers: formData.getHeaders(),
+        responseType: "stream",
+      });
+
+      res.status(200);
+      res.setHeader("Content-Type", "application/x-ndjson");
+      res.setHeader("Cache-Control", "no-cache");
+      res.setHeader("X-Accel-Buffering", "no");
+      res.flushHeaders();
+      pipeUpstream(llmResponse.data, res);
+    } catch (err: any) {
+      logger.err("Error calling LLM API:", err.message);
+      next(err);
+    }
+  }
+);
+
 // Get chat history from the LLM
 llmRouter.get(
   "/chat_history",
@@ -159,13 +219,14 @@ llmRouter.get(
   async (req: CustomRequest, res: Response, next: NextFunction) => {
     const user = req.user;
     const { chatId } = req.params;
+    const { before, limit } = req.query;
 
     if (!user) {
       res.status(401).json({ error: "Unauthorized" });
       return;
     }
 
-    logger.info("Getting chat history for chatId:", chatId);
+    logger.info("Getting chat history for chatId:", chatId, before);
 
     const userId = user._id.toString();
 
@@ -174,6 +235,8 @@ llmRouter.get(
         params: {
           userId,
           chatId,
+          before,
+          limit,
         },
       });
 
@@ -187,4 +250,46 @@ llmRouter.get(
   }
 );
 
+// Get one image of a chat by its index in the chat history
+llmRouter.get(
+  "/chat_image/:chatId/:index",
+  async (req: CustomRequest, res: Response, next: NextFunction) => {
+    const user = req.user;
+    const { chatId, index } = req.params;
+
+    if (!user) {
+      res.status(401).json({ error: "Unauthorized" });
+      return;
+    }
+
+    const userId = user._id.toString();
+    const etag = req.get("If-None-Match");
+
+    try {
+      const llmResponse = await axios.get(baseUrl + `/chat_image`, {
+        params: {
+          userId,
+          chatId,
+          index,
+        },
+        headers: etag ? { "If-None-Match": etag } : {},
+        responseType: "stream",
+        // Pass 304 and 404 responses on to the browser as they are
+        validateStatus: (status) => status < 500,
+      });
+
+      res.status(llmResponse.status);
+      for (const header of ["content-type", "cache-control", "etag"]) {
+        if (llmResponse.headers[header]) {
+          res.setHeader(header, llmResponse.headers[header]);
+        }
+      }
+      pipeUpstream(llmResponse.data, res);
+    } catch (err: any) {
+      logger.err("Error calling LLM API:", err.message);
+      next(err);
+    }
+  }
+);
+
 export default llmRouter;
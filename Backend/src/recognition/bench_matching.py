@@ -0,0 +1,66 @@
+"""
+Micro-benchmark for resolving recognized concept names against Fineli.
+
+Compares the serial per-concept lookup with the batch resolver used by
+detect_food_items and checks that both return the same food IDs.
+
+Usage: python bench_matching.py [--concepts 15] [--rounds 200]
+"""
+
+import argparse
+import random
+import time
+from foodindex import get_food_name_index
+import foodrecognition as fr
+
+
+def make_concepts(index, count, seed):
+    # Mix of exact, substring and misspelled names, like a model output
+    rng = random.Random(seed)
+    names = []
+    for _ in range(count):
+        name = rng.choice(index.choices)
+        kind = rng.random()
+        if kind < 0.3:
+            names.append(name)
+        elif kind < 0.6:
+            names.append(name[: max(3, len(name) // 2)])
+        else:
+            position = rng.randrange(len(name))
+            names.append(name[:position] + rng.choice("aeiouy") + name[position + 1 :])
+    return names
+
+
+def measure(function, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concepts", type=int, default=15)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    index = get_food_name_index(fr.FOODNAME_CSV)
+    names = make_concepts(index, args.concepts, args.seed)
+
+    serial = [index.lookup(name) for name in names]
+    batch = index.lookup_many(names)
+    if serial != batch:
+        raise SystemExit("Batch results differ from serial results")
+
+    serial_ms = measure(lambda: [index.lookup(name) for name in names], args.rounds)
+    batch_ms = measure(lambda: index.lookup_many(names), args.rounds)
+
+    print(f"{args.concepts} concepts, {args.rounds} rounds")
+    print(f"serial: {serial_ms:.3f} ms per response")
+    print(f"batch:  {batch_ms:.3f} ms per response")
+    print(f"speedup: {serial_ms / batch_ms:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
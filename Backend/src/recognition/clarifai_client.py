@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import os
+import random
+import grpc
+from clarifai_grpc.channel import clarifai_channel
+from clarifai_grpc.grpc.api import service_pb2_grpc
+import dotenv
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Point CLARIFAI_GRPC_BASE at a local fake V2 servicer (with
+# CLARIFAI_GRPC_INSECURE=true) to run against something other than Clarifai
+CLARIFAI_GRPC_BASE = os.getenv("CLARIFAI_GRPC_BASE", "api.clarifai.com")
+CLARIFAI_GRPC_INSECURE = os.getenv("CLARIFAI_GRPC_INSECURE", "false") == "true"
+CLARIFAI_TIMEOUT = float(os.getenv("CLARIFAI_TIMEOUT", "30"))  # seconds per call
+CLARIFAI_RETRIES = int(os.getenv("CLARIFAI_RETRIES", "3"))
+CLARIFAI_BACKOFF = float(os.getenv("CLARIFAI_BACKOFF", "0.2"))  # seconds
+
+CHANNEL_OPTIONS = [
+    ("grpc.service_config", clarifai_channel.grpc_json_config),
+    ("grpc.max_receive_message_length", clarifai_channel.MAX_MESSAGE_LENGTH),
+    ("grpc.max_send_message_length", clarifai_channel.MAX_MESSAGE_LENGTH),
+    # Keep the connection warm between requests so that a burst doesn't
+    # have to redo the TCP and TLS handshake. gRPC servers answer pings on
+    # an idle connection more often than every 5 minutes with a GOAWAY.
+    ("grpc.keepalive_time_ms", 300000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+UNHEALTHY_STATES = (
+    grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+    grpc.ChannelConnectivity.SHUTDOWN,
+)
+
+
+def _use_grpc_deserializer():
+    # V2Stub reads its response deserializer from a module global that
+    # ClarifaiChannel normally sets when it creates a channel
+    clarifai_channel.wrap_response_deserializer = (
+        clarifai_channel._response_deserializer_for_grpc
+    )
+
+
+def _backoff(attempt):
+    return CLARIFAI_BACKOFF * (2**attempt) * random.uniform(0.5, 1.5)
+
+
+class AsyncStubManager:
+    """
+    Owns one long-lived grpc.aio channel and V2Stub per worker.
+
+    The channel is created on first use and rebuilt when its connectivity
+    state turns unhealthy. Calls get a deadline and are retried with
+    exponential backoff when the server is UNAVAILABLE.
+
+    Must be used from the event loop that created it; each uvicorn worker
+    runs a single loop, so one instance per worker is enough.
+    """
+
+    def __init__(
+        self,
+        base=CLARIFAI_GRPC_BASE,
+        insecure=CLARIFAI_GRPC_INSECURE,
+        timeout=CLARIFAI_TIMEOUT,
+        retries=CLARIFAI_RETRIES,
+    ):
+        self.base = base
+        self.insecure = insecure
+        self.timeout = timeout
+        self.retries = retries
+        self.channel = None
+        self.stub = None
+        self.lock = asyncio.Lock()
+
+    def _connect(self):
+        _use_grpc_deserializer()
+        if self.insecure:
+            channel = grpc.aio.insecure_channel(self.base, options=CHANNEL_OPTIONS)
+        else:
+            channel = grpc.aio.secure_channel(
+                self.base, grpc.ssl_channel_credentials(), options=CHANNEL_OPTIONS
+            )
+        self.channel = channel
+        self.stub = service_pb2_grpc.V2Stub(channel)
+        logger.info(f"Opened async gRPC channel to {self.base}")
+
+    async def get_stub(self):
+        channel = self.channel
+        if channel is not None:
+            state = channel.get_state(try_to_connect=True)
+            if state not in UNHEALTHY_STATES:
+                return self.stub
+            logger.warning(f"gRPC channel is {state}, reconnecting")
+        async with self.lock:
+            # Only replace the channel found unhealthy above, another call may
+            # have reconnected while this one waited for the lock
+            if self.channel is channel:
+                self._connect()
+                if channel is not None:
+                    await channel.close()
+        return self.stub
+
+    async def call(self, method, request, metadata=None):
+        for attempt in range(self.retries + 1):
+            rpc = getattr(await self.get_stub(), method)
+            try:
+                return await rpc(request, metadata=metadata, timeout=self.timeout)
+            except grpc.aio.AioRpcError as e:
+                if e.code() != grpc.StatusCode.UNAVAILABLE or attempt == self.retries:
+                    raise
+                delay = _backoff(attempt)
+                logger.warning(f"{method} unavailable, retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        channel = self.channel
+        self.channel = None
+        self.stub = None
+        if channel is not None:
+            await channel.close()
+
+
+_async_manager = None
+
+
+def get_async_manager():
+    # One manager per worker process, created lazily on the first request
+    global _async_manager
+    if _async_manager is None:
+        _async_manager = AsyncStubManager()
+    return _async_manager
+
+
+async def close_async_manager():
+    global _async_manager
+    if _async_manager is not None:
+        await _async_manager.close()
+        _async_manager = None
@@ -0,0 +1,124 @@
+import csv
+from bisect import bisect_right
+from functools import lru_cache
+import numpy as np
+from rapidfuzz import fuzz, process
+
+FUZZY_SCORE_CUTOFF = 80
+
+
+class FoodNameIndex:
+    """
+    In-memory index over the Fineli food name list (foodname_EN.csv).
+
+    Built once per worker and reused for every lookup. Matching follows the
+    same precedence as the original row-by-row scan: an exact match on the
+    first comma-separated token of the name, then the first full name that
+    contains the query, then a RapidFuzz ratio match above the cutoff.
+    """
+
+    def __init__(self, rows):
+        # Exact matches: first token -> FOODID of the first row with that token
+        self.exact = {}
+        # Substring matches: unique full names in file order -> FOODID of the
+        # last row with that name (matches the old dict overwrite behaviour)
+        self.full_ids = {}
+        # Fuzzy fallback: first token -> FOODID of the last row with that token
+        self.fuzz_ids = {}
+
+        for food_id, food_name in rows:
+            food = food_name.split(",")[0].strip().lower()
+            food_full = food_name.strip().lower()
+            self.exact.setdefault(food, food_id)
+            self.full_ids[food_full] = food_id
+            self.fuzz_ids[food] = food_id
+
+        self.full_names = list(self.full_ids)
+        self.choices = list(self.fuzz_ids)
+
+        # All full names joined into one string so that a substring lookup is a
+        # single str.find, mapped back to the name with a bisect on the offsets
+        self.haystack = "\n".join(self.full_names)
+        self.offsets = []
+        offset = 0
+        for name in self.full_names:
+            self.offsets.append(offset)
+            offset += len(name) + 1
+
+    @classmethod
+    def from_csv(cls, csv_file):
+        with open(csv_file, mode="r", encoding="ISO-8859-1") as file:
+            reader = csv.DictReader(file, delimiter=";")
+            rows = [(row["FOODID"], row["FOODNAME"]) for row in reader]
+        return cls(rows)
+
+    def find_exact(self, food_name):
+        return self.exact.get(food_name.strip().lower())
+
+    def find_substring(self, food_name):
+        query = food_name.strip().lower()
+        if "\n" in query:
+            return None
+        position = self.haystack.find(query)
+        if position == -1:
+            return None
+        name = self.full_names[bisect_right(self.offsets, position) - 1]
+        return self.full_ids[name]
+
+    def find_fuzzy(self, food_name):
+        similarities = process.extractOne(
+            food_name,
+            self.choices,
+            scorer=fuzz.ratio,
+            score_cutoff=FUZZY_SCORE_CUTOFF,
+        )
+        if similarities and similarities[1] > FUZZY_SCORE_CUTOFF:
+            return self.fuzz_ids[similarities[0]]
+        return None
+
+    def lookup(self, food_name):
+        food_id = self.find_exact(food_name)
+        if food_id is None:
+            food_id = self.find_substring(food_name)
+        if food_id is None:
+            food_id = self.find_fuzzy(food_name)
+        return food_id
+
+    def lookup_many(self, food_names):
+        """
+        Resolve a batch of names with the same result as calling lookup() on
+        each one. Exact and substring passes run first and the remaining
+        misses are scored against the fuzzy choices in one cdist call.
+        """
+        results = {}
+        misses = []
+        for food_name in dict.fromkeys(food_names):
+            food_id = self.find_exact(food_name)
+            if food_id is None:
+                food_id = self.find_substring(food_name)
+            if food_id is None:
+                misses.append(food_name)
+            results[food_name] = food_id
+
+        if misses:
+            scores = process.cdist(
+                misses,
+                self.choices,
+                scorer=fuzz.ratio,
+                score_cutoff=FUZZY_SCORE_CUTOFF,
+                dtype=np.float64,
+                workers=-1,
+            )
+            # argmax returns the first best choice, like extractOne
+            best = scores.argmax(axis=1)
+            for food_name, row, column in zip(misses, scores, best):
+                if row[column] > FUZZY_SCORE_CUTOFF:
+                    results[food_name] = self.fuzz_ids[self.choices[column]]
+
+        return [results[food_name] for food_name in food_names]
+
+
+@lru_cache(maxsize=None)
+def get_food_name_index(csv_file):
+    # Loaded lazily on first use, then shared by every request in this worker
+    return FoodNameIndex.from_csv(csv_file)
@@ -1,8 +1,10 @@
-from clarifai_grpc.channel.clarifai_channel import ClarifaiChannel
-from clarifai_grpc.grpc.api import resources_pb2, service_pb2, service_pb2_grpc
+from clarifai_grpc.grpc.api import resources_pb2, service_pb2
 from clarifai_grpc.grpc.api.status import status_code_pb2
-import csv
-from rapidfuzz import fuzz, process
+import clarifai_client
+from foodindex import get_food_name_index
+from nutrients import get_nutrient_table
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import dotenv
 import os
 
@@ -12,29 +14,44 @@ USER_ID = os.getenv("USER_ID", "")
 APP_ID = os.getenv("APP_ID", "")
 MODEL_ID = os.getenv("MODEL_ID", "")
 
+FOODNAME_CSV = "foodname_EN.csv"
+COMPONENT_VALUE_CSV = "component_value.csv"
+# Optional memory-mapped copy of the nutrient table shared by all workers
+NUTRIENT_CACHE_FILE = os.getenv("NUTRIENT_CACHE_FILE", "")
+CONFIDENCE_THRESHOLD = 0.75
+# Threads for the CPU-bound Fineli matching of the async recognition path
+MATCHING_THREADS = int(os.getenv("MATCHING_THREADS", "4"))
+# Clarifai accepts at most 128 inputs per PostModelOutputs call
+MAX_INPUTS_PER_REQUEST = int(os.getenv("MAX_INPUTS_PER_REQUEST", "128"))
 
-def initialize_model(image_bytes):
-    channel = ClarifaiChannel.get_grpc_channel()
-    stub = service_pb2_grpc.V2Stub(channel)
+METADATA = (("authorization", f"Key {PAT}"),)
 
-    metadata = (("authorization", f"Key {PAT}"),)
+matching_executor = ThreadPoolExecutor(
+    max_workers=MATCHING_THREADS, thread_name_prefix="matching"
+)
 
+
+def build_request(*images):
     userDataObject = resources_pb2.UserAppIDSet(user_id=USER_ID, app_id=APP_ID)
 
-    post_model_outputs_response = stub.PostModelOutputs(
-        service_pb2.PostModelOutputsRequest(
-            user_app_id=userDataObject,
-            model_id=MODEL_ID,
-            inputs=[
-                resources_pb2.Input(
-                    data=resources_pb2.Data(
-                        image=resources_pb2.Image(base64=image_bytes)
-                    )
-                )
-            ],
-        ),
-        metadata=metadata,
+    inputs = []
+    for index, image_bytes in enumerate(images):
+        # Protobuf bytes fields only accept bytes, not other buffer types
+        if not isinstance(image_bytes, bytes):
+            image_bytes = bytes(image_bytes)
+        inputs.append(
+            resources_pb2.Input(
+                id=str(index),
+                data=resources_pb2.Data(image=resources_pb2.Image(base64=image_bytes)),
+            )
+        )
+
+    return service_pb2.PostModelOutputsRequest(
+        user_app_id=userDataObject, model_id=MODEL_ID, inputs=inputs
     )
+
+
+def check_response(post_model_outputs_response):
     if post_model_outputs_response.status.code != status_code_pb2.SUCCESS:
         print(post_model_outputs_response.status)
         raise Exception(
@@ -44,84 +61,136 @@ def initialize_model(image_bytes):
     return post_model_outputs_response
 
 
-def get_food_id(food_name, csv_file):
-    with open(csv_file, mode="r", encoding="ISO-8859-1") as file:
-        matches = {}
-        fuzzwords = {}
-        reader = csv.DictReader(file, delimiter=";")
-        for row in reader:
-            food = row["FOODNAME"].split(",")[0].strip().lower()
-            food_full = row["FOODNAME"].strip().lower()
-            if food == food_name.strip().lower():
-                return row["FOODID"]
-            if food_name.strip().lower() in food_full:
-                matches[food_full] = row["FOODID"]
-            fuzzwords[food] = row["FOODID"]
-        if matches:
-            return list(matches.values())[0]
-        similarities = process.extractOne(
-            food_name, fuzzwords.keys(), scorer=fuzz.ratio
-        )
-        if similarities[1] > 80:
-            return fuzzwords[similarities[0]]
-    return None
+async def initialize_model_async(image_bytes):
+    post_model_outputs_response = await clarifai_client.get_async_manager().call(
+        "PostModelOutputs", build_request(image_bytes), metadata=METADATA
+    )
+    return check_response(post_model_outputs_response)
+
+
+async def initialize_model_batch_async(images):
+    # Split the images into as few calls as the per-request input limit
+    # allows, send them concurrently and return the outputs in input order
+    chunks = [
+        images[start : start + MAX_INPUTS_PER_REQUEST]
+        for start in range(0, len(images), MAX_INPUTS_PER_REQUEST)
+    ]
+    manager = clarifai_client.get_async_manager()
+    responses = await asyncio.gather(
+        *[
+            manager.call("PostModelOutputs", build_request(*chunk), metadata=METADATA)
+            for chunk in chunks
+        ]
+    )
+
+    outputs = []
+    for chunk, post_model_outputs_response in zip(chunks, responses):
+        if post_model_outputs_response.status.code != status_code_pb2.MIXED_STATUS:
+            check_response(post_model_outputs_response)
+        by_input = {
+            output.input.id: output for output in post_model_outputs_response.outputs
+        }
+        outputs.extend(by_input.get(str(index)) for index in range(len(chunk)))
+    return outputs
 
 
 def get_macronutrients(food_id, csv_file):
-    macronutrients = {
-        "Kilocalories": None,
-        "Protein": None,
-        "Carbohydrates": None,
-        "Fat": None,
-    }
-    eufdname = {
-        "ENERC": "Kilocalories",
-        "PROT": "Protein",
-        "CHOAVL": "Carbohydrates",
-        "FAT": "Fat",
-    }
-    with open(csv_file, mode="r", encoding="ISO-8859-1") as file:
-        reader = csv.reader(file, delimiter=";")
-        for row in reader:
-            if row[0] == str(food_id) and row[1] in eufdname:
-                value = float(row[2].replace(",", "."))
-                if row[1] == "ENERC":
-                    value = round(value * 0.239, 2)  # kJ to kcal
-                macronutrients[eufdname[row[1]]] = value
-    return macronutrients
+    return get_nutrient_table(csv_file, NUTRIENT_CACHE_FILE).lookup(food_id)
 
 
-def detect_food_items(post_model_outputs_response):
+def preload():
+    # Build the lookup tables up front so the first request doesn't pay for it
+    get_food_name_index(FOODNAME_CSV)
+    get_nutrient_table(COMPONENT_VALUE_CSV, NUTRIENT_CACHE_FILE)
+
+
+def get_food_ids(food_names, csv_file):
+    return get_food_name_index(csv_file).lookup_many(food_names)
+
+
+def confident_concepts(output):
+    if hasattr(output.data, "concepts") and output.data.concepts:
+        return [
+            concept
+            for concept in output.data.concepts
+            if concept.value > CONFIDENCE_THRESHOLD
+        ]
+    raise Exception("No food items detected in output.")
+
+
+def build_food_items(concepts, food_ids):
     items = []
+    for concept, food_id in zip(concepts, food_ids):
+        document = {
+            "name": concept.name,
+            "confidence": round(concept.value, 4),
+        }
+        if food_id:
+            document["macronutrients"] = get_macronutrients(
+                food_id, COMPONENT_VALUE_CSV
+            )
+        items.append(document)
+    return items
+
+
+def detect_food_items(post_model_outputs_response):
+    concepts = []
     for output in post_model_outputs_response.outputs:
-        if hasattr(output.data, "concepts") and output.data.concepts:
-            for concept in output.data.concepts:
-                if concept.value > 0.75:  # Confidence threshold
-                    food_id = get_food_id(concept.name, "foodname_EN.csv")
-                    if food_id:
-                        macronutrients = get_macronutrients(
-                            food_id, "component_value.csv"
-                        )
-                        document = {
-                            "name": concept.name,
-                            "confidence": round(concept.value, 4),
-                            "macronutrients": macronutrients,
-                        }
-                        items.append(document)
-                    else:
-                        document = {
-                            "name": concept.name,
-                            "confidence": round(concept.value, 4),
-                        }
-                        items.append(document)
+        concepts.extend(confident_concepts(output))
+
+    # Resolve every concept name against Fineli in one batch
+    food_ids = get_food_ids([concept.name for concept in concepts], FOODNAME_CSV)
+    return build_food_items(concepts, food_ids)
+
+
+def detect_food_items_batch(outputs):
+    # One entry per output: its food items, or an error dict when the input
+    # failed or nothing was detected
+    concepts_per_output = []
+    for output in outputs:
+        if output is None:
+            concepts_per_output.append(Exception("No output returned for image."))
+        elif output.status.code != status_code_pb2.SUCCESS:
+            concepts_per_output.append(Exception(output.status.description))
         else:
-            raise Exception("No food items detected in output.")
+            try:
+                concepts_per_output.append(confident_concepts(output))
+            except Exception as e:
+                concepts_per_output.append(e)
 
-    return items
+    # Resolve the concepts of every image against Fineli in one batch
+    names = [
+        concept.name
+        for concepts in concepts_per_output
+        if isinstance(concepts, list)
+        for concept in concepts
+    ]
+    food_ids = iter(get_food_ids(names, FOODNAME_CSV))
+
+    results = []
+    for concepts in concepts_per_output:
+        if isinstance(concepts, Exception):
+            results.append({"error": str(concepts)})
+        else:
+            results.append(
+                build_food_items(concepts, [next(food_ids) for _ in concepts])
+            )
+    return results
 
 
-def recognize_image(file_path):
-    with open(file_path, "rb") as f:
-        image_bytes = f.read()
-    post_model_outputs_response = initialize_model(image_bytes)
-    return detect_food_items(post_model_outputs_response)
+async def recognize_image_bytes_async(image_bytes):
+    # Only the Clarifai call runs on the event loop; the Fineli matching goes
+    # to the bounded thread pool
+    loop = asyncio.get_running_loop()
+    post_model_outputs_response = await initialize_model_async(image_bytes)
+    return await loop.run_in_executor(
+        matching_executor, detect_food_items, post_model_outputs_response
+    )
+
+
+async def recognize_images_bytes_async(images):
+    loop = asyncio.get_running_loop()
+    outputs = await initialize_model_batch_async(images)
+    return await loop.run_in_executor(
+        matching_executor, detect_food_items_batch, outputs
+    )
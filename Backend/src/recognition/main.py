@@ -1,11 +1,27 @@
+import asyncio
 import json
 import os
-from fastapi import FastAPI, File, UploadFile, Form
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional
+from fastapi.responses import JSONResponse
+from starlette.formparsers import MultiPartParser
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional
 import logging
 import sys
+import uuid
 import foodrecognition as fr
+import imageprep
+from result_cache import RecognitionCache
+from schemas import (
+    BatchRecognitionResult,
+    ORJSONResponse,
+    RecognitionError,
+    RecognitionResult,
+    batch_recognition_result,
+    recognition_response,
+)
 import dotenv
 
 dotenv.load_dotenv()
@@ -28,7 +44,99 @@ console_handler.setFormatter(formatter)
 # Add the handler to the logger
 logger.addHandler(console_handler)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the Fineli lookup tables once per worker before serving requests
+    try:
+        fr.preload()
+    except FileNotFoundError as e:
+        logger.warning(f"Could not preload Fineli data: {e}")
+    yield
+    await fr.clarifai_client.close_async_manager()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Uploads are kept in memory. Set RECOGNITION_DEBUG_CAPTURE=true to also save
+# every received image to UPLOAD_DIR for debugging.
+UPLOAD_DIR = "./uploads"
+DEBUG_CAPTURE = os.getenv("RECOGNITION_DEBUG_CAPTURE", "false") == "true"
+if DEBUG_CAPTURE:
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+# Largest accepted upload in bytes, 0 disables the limit
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", "0"))
+# Room for the multipart framing and form fields around the images
+UPLOAD_OVERHEAD_BYTES = 64 * 1024
+# Most images accepted by one /recognize/batch request
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", "16"))
+
+# Starlette spills uploads over 1 MB to a temporary file while parsing the
+# form. With a limit, every accepted upload is kept in memory instead.
+if MAX_UPLOAD_BYTES:
+    MultiPartParser.spool_max_size = max(
+        MultiPartParser.spool_max_size, MAX_UPLOAD_BYTES
+    )
+
+# Recognitions running at once per worker, and how many more may wait for a
+# slot before new requests are turned away with 503
+MAX_CONCURRENT_RECOGNITIONS = int(os.getenv("MAX_CONCURRENT_RECOGNITIONS", "16"))
+MAX_QUEUED_RECOGNITIONS = int(os.getenv("MAX_QUEUED_RECOGNITIONS", "32"))
+RETRY_AFTER_SECONDS = os.getenv("RETRY_AFTER_SECONDS", "2")
+
+
+def body_limit(path):
+    # Largest request body accepted on a path, None without a limit
+    if not MAX_UPLOAD_BYTES:
+        return None
+    if path == "/recognize":
+        return MAX_UPLOAD_BYTES + UPLOAD_OVERHEAD_BYTES
+    if path == "/recognize/batch":
+        return MAX_UPLOAD_BYTES * MAX_BATCH_IMAGES + UPLOAD_OVERHEAD_BYTES
+    return None
+
+
+class UploadLimitMiddleware:
+    """
+    Rejects oversized uploads before the form is parsed: from the
+    Content-Length header when there is one, otherwise as soon as the body
+    received so far passes the limit.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        limit = body_limit(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > limit:
+            response = JSONResponse({"detail": too_large_detail()}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # FastAPI passes HTTPExceptions raised while reading the
+                    # body on as they are
+                    raise_too_large()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+# Added before CORSMiddleware, which then also covers its responses
+app.add_middleware(UploadLimitMiddleware)
 
 origins = [
     "http://localhost:3000",
@@ -42,39 +150,196 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-UPLOAD_DIR = "./uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+recognition_cache = RecognitionCache()
+recognition_slots = asyncio.Semaphore(MAX_CONCURRENT_RECOGNITIONS)
+pending_recognitions = 0
+
+
+@asynccontextmanager
+async def recognition_slot():
+    global pending_recognitions
+    if pending_recognitions >= MAX_CONCURRENT_RECOGNITIONS + MAX_QUEUED_RECOGNITIONS:
+        logger.warning("Recognition queue is full, rejecting request")
+        raise HTTPException(
+            status_code=503,
+            detail="Recognition service is busy, try again later",
+            headers={"Retry-After": RETRY_AFTER_SECONDS},
+        )
+    pending_recognitions += 1
+    try:
+        async with recognition_slots:
+            yield
+    finally:
+        pending_recognitions -= 1
 
 
-@app.post("/recognize")
+@app.post(
+    "/recognize",
+    response_model=RecognitionResult,
+    responses={500: {"model": RecognitionError}},
+)
 async def recognize_image(
     image: UploadFile = File(..., description="The image to process"),
     description: Optional[str] = Form(
         None, description="Optional description of the image"
     ),
+    compact: bool = Query(False, description="Leave out unknown macronutrients"),
 ):
     """
     Endpoint to receive an image and use the food recognition
     model to identify the food in the image.
     """
-    try:
-        contents = await image.read()
+    contents = await read_upload(image)
+
+    async with recognition_slot():
+        try:
+            if DEBUG_CAPTURE:
+                file_path = os.path.join(
+                    UPLOAD_DIR, f"{uuid.uuid4().hex}_{os.path.basename(image.filename)}"
+                )
+                await run_in_threadpool(write_file, file_path, contents)
+                logger.debug(f"Captured image to {file_path}")
+
+            # Reuse the result of an earlier upload of the same image
+            cache_keys = await run_in_threadpool(
+                recognition_cache.keys_for,
+                contents,
+                fr.MODEL_ID,
+                fr.CONFIDENCE_THRESHOLD,
+            )
+            result = await run_in_threadpool(recognition_cache.get, cache_keys)
+            cache_hit = result is not None
+
+            if result is None:
+                # Downscale and re-encode before uploading it to Clarifai
+                try:
+                    prepared = await run_in_threadpool(
+                        imageprep.prepare_image, contents
+                    )
+                except imageprep.ImageTooLarge as e:
+                    raise HTTPException(status_code=413, detail=str(e))
+
+                # Call the food recognition model
+                result = await fr.recognize_image_bytes_async(prepared.data)
+                await run_in_threadpool(recognition_cache.set, cache_keys, result)
+            logger.info(f"Food recognition result:\n{json.dumps(result)}")
+
+            # Return the result
+            response = recognition_response(result, compact)
+            set_cache_headers(response, cache_hit)
+            return response
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            return error_response(e)
+
+
+@app.post(
+    "/recognize/batch",
+    response_model=BatchRecognitionResult,
+    responses={500: {"model": RecognitionError}},
+)
+async def recognize_images(
+    images: List[UploadFile] = File(..., description="The images to process"),
+    compact: bool = Query(False, description="Leave out unknown macronutrients"),
+):
+    """
+    Endpoint to recognize several images in one request. The images are
+    sent to the model in as few calls as possible and the results are
+    returned in the same order as the uploads.
+    """
+    if len(images) > MAX_BATCH_IMAGES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {MAX_BATCH_IMAGES} images can be sent at once",
+        )
+
+    contents = [await read_upload(image) for image in images]
+
+    async with recognition_slot():
+        try:
+            # Look up every image in the cache first
+            results = []
+            cache_keys = []
+            for image_bytes in contents:
+                keys = await run_in_threadpool(
+                    recognition_cache.keys_for,
+                    image_bytes,
+                    fr.MODEL_ID,
+                    fr.CONFIDENCE_THRESHOLD,
+                )
+                cache_keys.append(keys)
+                results.append(await run_in_threadpool(recognition_cache.get, keys))
+
+            # Recognize the remaining images together, sending duplicate
+            # uploads only once
+            misses = {}
+            for index, result in enumerate(results):
+                if result is None:
+                    misses.setdefault(cache_keys[index][0], []).append(index)
+            prepared = {}
+            for key, indexes in misses.items():
+                try:
+                    prepared[key] = await run_in_threadpool(
+                        imageprep.prepare_image, contents[indexes[0]]
+                    )
+                except imageprep.ImageTooLarge as e:
+                    for index in indexes:
+                        results[index] = {"error": str(e)}
+            if prepared:
+                recognized = await fr.recognize_images_bytes_async(
+                    [image.data for image in prepared.values()]
+                )
+                for key, result in zip(prepared, recognized):
+                    indexes = misses[key]
+                    for index in indexes:
+                        results[index] = result
+                    if not isinstance(result, dict):
+                        await run_in_threadpool(
+                            recognition_cache.set, cache_keys[indexes[0]], result
+                        )
+
+            logger.info(f"Food recognition batch result:\n{json.dumps(results)}")
+            response = recognition_response(results, compact, batch_recognition_result)
+            set_cache_headers(response)
+            return response
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            return error_response(e)
+
+
+async def read_upload(image: UploadFile):
+    # UploadLimitMiddleware has already capped the whole request. This
+    # applies the limit to each image of a batch.
+    if MAX_UPLOAD_BYTES and image.size and image.size > MAX_UPLOAD_BYTES:
+        raise_too_large()
+    return await image.read()
+
+
+def too_large_detail():
+    return f"Image is larger than the {MAX_UPLOAD_BYTES} byte limit"
+
+
+def raise_too_large():
+    raise HTTPException(status_code=413, detail=too_large_detail())
+
 
-        # Save the image to the uploads directory
-        file_path = os.path.join(UPLOAD_DIR, image.filename)
-        with open(file_path, "wb") as f:
-            f.write(contents)
-        logger.info(f"Saved image to {file_path}")
+def error_response(e: Exception):
+    # Returned as is, since the error body does not match the result models
+    logger.error(f"Food recognition failed: {e}")
+    return ORJSONResponse({"error": str(e)}, status_code=500)
 
-        # Call the food recognition model
-        result = fr.recognize_image(file_path)
-        logger.info(f"Food recognition result:\n{json.dumps(result)}")
 
-        # Remove the image file
-        os.remove(file_path)
+def set_cache_headers(response: Response, hit=None):
+    if hit is not None:
+        response.headers["X-Cache"] = "HIT" if hit else "MISS"
+    response.headers["X-Cache-Hits"] = str(recognition_cache.hits)
+    response.headers["X-Cache-Misses"] = str(recognition_cache.misses)
 
-        # Return the result
-        return str(result)
 
-    except Exception as e:
-        return {"error": str(e)}
+def write_file(file_path, contents):
+    with open(file_path, "wb") as f:
+        f.write(contents)
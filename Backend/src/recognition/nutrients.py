@@ -0,0 +1,134 @@
+import csv
+import math
+import mmap
+import os
+import struct
+from array import array
+from functools import lru_cache
+
+# Fineli EUFDNAME codes loaded into the table, in column order
+COMPONENTS = {
+    "ENERC": "Kilocalories",
+    "PROT": "Protein",
+    "CHOAVL": "Carbohydrates",
+    "FAT": "Fat",
+}
+# Energy is given in kJ. LLM/fineli_store.py converts it the same way.
+KJ_PER_KCAL = 4.184
+
+# Binary cache layout: header, FOODID column (int32), padding to 8 bytes,
+# then one row of float64 component values per food (NaN when missing)
+CACHE_MAGIC = b"NVNT"
+CACHE_VERSION = 2
+CACHE_HEADER = struct.Struct("<4sIII")
+
+
+class NutrientTable:
+    """
+    Columnar view of the Fineli component value table (component_value.csv).
+
+    Values are parsed and converted once at load time and stored as a packed
+    float64 array with one row per food, so a lookup is one dict access plus
+    a slice. The array can be backed by a memory-mapped cache file, which
+    lets every uvicorn worker share the same pages.
+    """
+
+    def __init__(self, food_ids, values):
+        self.columns = list(COMPONENTS.values())
+        self.width = len(self.columns)
+        self.values = values
+        self.offsets = {
+            str(food_id): row * self.width for row, food_id in enumerate(food_ids)
+        }
+
+    @classmethod
+    def from_csv(cls, csv_file):
+        column_index = {code: i for i, code in enumerate(COMPONENTS)}
+        rows = {}
+        with open(csv_file, mode="r", encoding="ISO-8859-1") as file:
+            reader = csv.reader(file, delimiter=";")
+            for row in reader:
+                if len(row) < 3 or row[1] not in column_index:
+                    continue
+                value = float(row[2].replace(",", "."))
+                if row[1] == "ENERC":
+                    value = round(value / KJ_PER_KCAL, 2)
+                values = rows.setdefault(int(row[0]), [math.nan] * len(COMPONENTS))
+                values[column_index[row[1]]] = value
+
+        food_ids = array("i", rows)
+        values = array("d")
+        for food_values in rows.values():
+            values.extend(food_values)
+        return cls(food_ids, values)
+
+    @classmethod
+    def from_cache(cls, cache_file):
+        with open(cache_file, "rb") as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, width = CACHE_HEADER.unpack_from(buffer)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            raise ValueError(f"Unsupported nutrient cache file: {cache_file}")
+        if width != len(COMPONENTS):
+            raise ValueError(f"Nutrient cache column mismatch: {cache_file}")
+
+        ids_start = CACHE_HEADER.size
+        values_start = _align(ids_start + count * 4)
+        view = memoryview(buffer)
+        food_ids = view[ids_start : ids_start + count * 4].cast("i")
+        values = view[values_start : values_start + count * width * 8].cast("d")
+        return cls(food_ids, values)
+
+    def write_cache(self, cache_file):
+        food_ids = array("i", (int(food_id) for food_id in self.offsets))
+        header = CACHE_HEADER.pack(
+            CACHE_MAGIC, CACHE_VERSION, len(food_ids), self.width
+        )
+        padding = _align(len(header) + len(food_ids) * 4) - (
+            len(header) + len(food_ids) * 4
+        )
+        # Other workers may be mapping the old cache. Each worker writes its
+        # own temporary file and renames it over the cache, and the old pages
+        # stay valid for whoever still maps them.
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as file:
+            file.write(header)
+            file.write(food_ids.tobytes())
+            file.write(b"\0" * padding)
+            file.write(array("d", self.values).tobytes())
+        os.replace(tmp_file, cache_file)
+
+    def lookup(self, food_id):
+        macronutrients = dict.fromkeys(self.columns)
+        offset = self.offsets.get(str(food_id))
+        if offset is None:
+            return macronutrients
+        for column, value in zip(
+            self.columns, self.values[offset : offset + self.width]
+        ):
+            if not math.isnan(value):
+                macronutrients[column] = value
+        return macronutrients
+
+
+def _align(size, alignment=8):
+    return (size + alignment - 1) // alignment * alignment
+
+
+@lru_cache(maxsize=None)
+def get_nutrient_table(csv_file, cache_file=None):
+    # Reuse the binary cache when it is newer than the CSV, otherwise rebuild
+    # it. Without a cache file the table is parsed into this worker's memory.
+    if not cache_file:
+        return NutrientTable.from_csv(csv_file)
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(
+        csv_file
+    ):
+        try:
+            return NutrientTable.from_cache(cache_file)
+        except ValueError:
+            # Written by another version, rebuild it
+            pass
+    table = NutrientTable.from_csv(csv_file)
+    table.write_cache(cache_file)
+    return NutrientTable.from_cache(cache_file)
@@ -0,0 +1,151 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import dotenv
+
+dotenv.load_dotenv()
+
+RECOGNITION_CACHE_SIZE = int(os.getenv("RECOGNITION_CACHE_SIZE", "1024"))
+RECOGNITION_CACHE_TTL = float(os.getenv("RECOGNITION_CACHE_TTL", "86400"))  # seconds
+# Optional SQLite file shared by all uvicorn workers, empty to disable
+RECOGNITION_CACHE_DB = os.getenv("RECOGNITION_CACHE_DB", "")
+# Also match re-encoded copies of the same photo by a perceptual hash
+RECOGNITION_CACHE_PHASH = os.getenv("RECOGNITION_CACHE_PHASH", "false") == "true"
+
+
+def image_hash(image_bytes):
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+
+def perceptual_hash(image_bytes):
+    # 64-bit difference hash: shrink to 9x8 greyscale and compare neighbours
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        pixels = list(image.convert("L").resize((9, 8)).getdata())
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:016x}"
+
+
+class RecognitionCache:
+    """
+    Recognition results keyed by image content, model and threshold.
+
+    An in-process LRU with a TTL sits in front of an optional SQLite store
+    that all workers on the host can read and write.
+    """
+
+    def __init__(
+        self,
+        max_size=RECOGNITION_CACHE_SIZE,
+        ttl=RECOGNITION_CACHE_TTL,
+        db_path=RECOGNITION_CACHE_DB,
+        perceptual=RECOGNITION_CACHE_PHASH,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_path = db_path
+        self.perceptual = perceptual
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if db_path:
+            with self._connect() as connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS recognition_cache "
+                    "(key TEXT PRIMARY KEY, result TEXT, expires REAL)"
+                )
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=5)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def keys_for(self, image_bytes, model_id, threshold):
+        suffix = f"{model_id}:{threshold}"
+        keys = [f"sha:{image_hash(image_bytes)}:{suffix}"]
+        if self.perceptual:
+            try:
+                keys.append(f"phash:{perceptual_hash(image_bytes)}:{suffix}")
+            except Exception:
+                # Not an image Pillow can decode, the exact key still works
+                pass
+        return keys
+
+    def get(self, keys):
+        now = time.time()
+        result = self._get_local(keys, now)
+        if result is None and self.db_path:
+            result = self._get_shared(keys, now)
+            if result is not None:
+                self._set_local(keys, result, now)
+        with self.lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def set(self, keys, result):
+        now = time.time()
+        self._set_local(keys, result, now)
+        if self.db_path:
+            value = json.dumps(result)
+            with self._connect() as connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO recognition_cache VALUES (?, ?, ?)",
+                    [(key, value, now + self.ttl) for key in keys],
+                )
+
+    def _get_local(self, keys, now):
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                expires, result = entry
+                if expires < now:
+                    del self.entries[key]
+                    continue
+                self.entries.move_to_end(key)
+                return result
+        return None
+
+    def _set_local(self, keys, result, now):
+        with self.lock:
+            for key in keys:
+                self.entries[key] = (now + self.ttl, result)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def _get_shared(self, keys, now):
+        with self._connect() as connection:
+            for key in keys:
+                row = connection.execute(
+                    "SELECT result FROM recognition_cache WHERE key = ? AND expires >= ?",
+                    (key, now),
+                ).fetchone()
+                if row:
+                    return json.loads(row[0])
+            connection.execute(
+                "DELETE FROM recognition_cache WHERE expires < ?", (now,)
+            )
+        return None
@@ -0,0 +1,41 @@
+from typing import List, Optional, Union
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, TypeAdapter
+
+
+class Macronutrients(BaseModel):
+    # Values per 100 grams from Fineli
+    Kilocalories: Optional[float] = None
+    Protein: Optional[float] = None
+    Carbohydrates: Optional[float] = None
+    Fat: Optional[float] = None
+
+
+class RecognizedItem(BaseModel):
+    name: str
+    confidence: float
+    macronutrients: Optional[Macronutrients] = None
+
+
+class RecognitionError(BaseModel):
+    error: str
+
+
+RecognitionResult = List[RecognizedItem]
+BatchRecognitionResult = List[Union[RecognitionResult, RecognitionError]]
+
+recognition_result = TypeAdapter(RecognitionResult)
+batch_recognition_result = TypeAdapter(BatchRecognitionResult)
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content):
+        return orjson.dumps(content)
+
+
+def recognition_response(result, compact=False, adapter=recognition_result):
+    # Compact mode leaves out unknown macronutrients and the macronutrients
+    # of items that were not found in Fineli
+    items = adapter.validate_python(result)
+    return ORJSONResponse(adapter.dump_python(items, exclude_none=compact))
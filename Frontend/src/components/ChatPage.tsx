@@ -23,6 +23,7 @@ const ChatPage: React.FC = () => {
   const [imagePreview, setImagePreview] = useState<string | null>(null);
   const [chatInput, setChatInput] = useState<string>("");
   const [loading, setLoading] = useState<boolean>(false);
+  const [streamingReply, setStreamingReply] = useState<string>("");
   const [alertMessage, setAlertMessage] = useState<string | null>(null);
   const [newChat, setNewChat] = useState<boolean>(false);
   const [allChats, setAllChats] = useState<{ id: string; name: string }[]>([]);
@@ -31,6 +32,7 @@ const ChatPage: React.FC = () => {
   const [chatHistory, setChatHistory] = useState<
     { user: { message: string; image: File | null }; bot: string }[]
   >([]);
+  const [olderCursor, setOlderCursor] = useState<number | null>(null);
   const [inputState, setInputState] = useState<{
     message: string;
     imagePreview: string | null;
@@ -123,15 +125,48 @@ const ChatPage: React.FC = () => {
     }
   }, []);
 
+  /**
+   * Load one image of a chat from the backend
+   *
+   * @param chatId - ID of the chat
+   * @param index - Index of the message in the chat history
+   */
+  const loadChatImage = async (chatId: string, index: number) => {
+    try {
+      const response = await axios.get(
+        `${baseLLMUrl}/chat_image/${chatId}/${index}`,
+        {
+          headers: {
+            Authorization: `Bearer ${localStorage.getItem("token")}`,
+          },
+          responseType: "blob",
+        }
+      );
+      const blob: Blob = response.data;
+      return new File([blob], "image.png", { type: blob.type });
+    } catch (error) {
+      console.error("Error loading chat image", error);
+      return null;
+    }
+  };
+
   /**
    * Load chat history from the backend
+   *
+   * Messages are loaded a page at a time, newest first. Without a cursor the
+   * latest page replaces the history, with one the page before the cursor is
+   * added to the older end.
+   *
+   * @param latestChatId - ID of the chat
+   * @param before - Cursor returned with the previous page
    */
-  const loadChatHistory = async (latestChatId: string) => {
+  const loadChatHistory = async (latestChatId: string, before?: number) => {
     try {
       if (latestChatId) {
         const response = await axios.get(
           `${baseLLMUrl}/chat_one/${latestChatId}`,
           {
+            params: { before },
             headers: {
               Authorization: `Bearer ${localStorage.getItem("token")}`,
             },
@@ -143,25 +178,12 @@ const ChatPage: React.FC = () => {
         const data = response.data;
 
         console.log("Chat history: ", data);
-        const history = data
-          .map((item: any) => {
-            let file: File | null = null;
-
-            if (item.image) {
-              const byteString = atob(item.image.split(",")[1]); // Decode Base64
-              const mimeString = item.image
-                .split(",")[0]
-                .split(":")[1]
-                .split(";")[0];
-
-              const byteArray = new Uint8Array(byteString.length);
-              for (let i = 0; i < byteString.length; i++) {
-                byteArray[i] = byteString.charCodeAt(i);
-              }
-
-              const blob = new Blob([byteArray], { type: mimeString });
-              file = new File([blob], "image.png", { type: mimeString });
-            }
+        const history = await Promise.all(
+          data.history.map(async (item: any) => {
+            // Images are not part of the page, they are loaded one by one
+            const file: File | null = item.has_image
+              ? await loadChatImage(latestChatId, item.index)
+              : null;
 
             let bot_message = "";
             const image_result = item.image_result;
@@ -181,8 +203,12 @@ const ChatPage: React.FC = () => {
               bot: bot_message.trim(),
             };
           })
-          .reverse();
-        setChatHistory(history);
+        );
+        history.reverse();
+        setChatHistory((previous) =>
+          before === undefined ? history : [...previous, ...history]
+        );
+        setOlderCursor(data.next_cursor);
       }
     } catch (error) {
       console.error("Error loading chat history", error);
@@ -276,7 +302,9 @@ const ChatPage: React.FC = () => {
       if (response.status !== 200) {
         throw new Error("Failed to recognize image");
       }
-      return data;
+      // The recognition API returns a JSON list, which is passed on to the
+      // chat as a string
+      return typeof data === "string" ? data : JSON.stringify(data);
     } catch (error) {
       console.error("Error recognizing image:", error);
       return "";
@@ -315,24 +343,66 @@ const ChatPage: React.FC = () => {
         "Chat ID:",
         chatId
       );
-      const response = await axios.post(baseLLMUrl + "/chat", formData, {
+      // The reply is streamed as newline-delimited JSON events: metadata
+      // first, then tokens as they are generated, then the whole reply
+      const response = await fetch(baseLLMUrl + "/chat/stream", {
+        method: "POST",
         headers: {
           Authorization: `Bearer ${localStorage.getItem("token")}`,
         },
+        body: formData,
       });
 
-      if (response.status !== 200) {
+      if (!response.ok || !response.body) {
         throw new Error("Failed to fetch LLM response");
       }
 
-      const data = await response.data;
-      const botReply = data.response;
-      const imageResult = data.image_result;
-      const nutritionMessage = data.nutrition_message;
-      let botMessage = "";
-      botMessage = formBotMessage(botReply, imageResult, nutritionMessage);
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffered = "";
+      let botReply = "";
+      let imageResult: string | null = null;
+      let nutritionMessage: string | null = null;
+      let done = false;
+
+      while (!done) {
+        const chunk = await reader.read();
+        if (chunk.done) break;
+        buffered += decoder.decode(chunk.value, { stream: true });
+        const lines = buffered.split("\n");
+        buffered = lines.pop() || "";
+
+        for (const line of lines) {
+          if (!line.trim()) continue;
+          const event = JSON.parse(line);
+          if (event.type === "metadata") {
+            imageResult = event.image_result;
+            nutritionMessage = event.nutrition_message;
+          } else if (event.type === "token") {
+            botReply += event.content;
+          } else if (event.type === "done") {
+            botReply = event.response;
+            done = true;
+          } else if (event.type === "error") {
+            throw new Error(event.error);
+          }
+          setStreamingReply(
+            formBotMessage(botReply, imageResult, nutritionMessage)
+          );
+        }
+      }
+
+      if (!done) {
+        throw new Error("LLM response stream ended early");
+      }
+
+      const botMessage = formBotMessage(
+        botReply,
+        imageResult,
+        nutritionMessage
+      );
       console.log("Bot Message:", botReply);
-      setChatHistory([
+      setChatHistory((previous) => [
         {
           user: {
             message: userMessage,
@@ -340,7 +410,7 @@ const ChatPage: React.FC = () => {
           },
           bot: botMessage.trim(),
         },
-        ...chatHistory,
+        ...previous,
       ]);
     } catch (error: any) {
       if (axios.isCancel(error)) {
@@ -399,6 +469,7 @@ const ChatPage: React.FC = () => {
     } finally {
       console.log("Chat submission completed");
       setLoading(false);
+      setStreamingReply("");
       setInputState({ message: "", imagePreview: null });
     }
   };
@@ -469,6 +540,7 @@ const ChatPage: React.FC = () => {
     setImagePreview(null);
     setInputState({ message: "", imagePreview: null });
     setChatHistory([]);
+    setOlderCursor(null);
     navigate("/chat", { replace: true });
   };
 
@@ -653,11 +725,15 @@ const ChatPage: React.FC = () => {
                 {formatText(inputState.message)}
               </div>
               <div className="BotMessage">
-                <span className="loading-dots">
-                  <span>•</span>
-                  <span>•</span>
-                  <span>•</span>
-                </span>
+                {streamingReply ? (
+                  formatText(streamingReply)
+                ) : (
+                  <span className="loading-dots">
+                    <span>•</span>
+                    <span>•</span>
+                    <span>•</span>
+                  </span>
+                )}
               </div>
             </div>
           )}
@@ -676,6 +752,16 @@ const ChatPage: React.FC = () => {
               <div className="BotMessage">{formatText(chat.bot)}</div>
             </div>
           ))}
+          {olderCursor !== null && params["chat-id"] && (
+            <button
+              className="LoadOlderButton"
+              onClick={() =>
+                loadChatHistory(params["chat-id"] as string, olderCursor)
+              }
+            >
+              Load earlier messages
+            </button>
+          )}
         </div>
         <div className={inputContainerClass}>
           {imagePreview && (